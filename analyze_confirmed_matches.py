@@ -1,11 +1,8 @@
 #!/usr/bin/env python3
 """Analyze confirmed crash-involved vehicles"""
 
-import csv
-import sys
-from collections import Counter
-
-csv.field_size_limit(sys.maxsize)
+import numpy as np
+import pandas as pd
 
 print("="*80)
 print("CONFIRMED CRASH-INVOLVED VEHICLES - ANALYSIS")
@@ -16,66 +13,91 @@ print("\n" + "="*80)
 print("5-MINUTE WINDOW (HIGHEST CONFIDENCE)")
 print("="*80)
 
-matches = []
-with open('confirmed_crash_vehicles_5min.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    matches = list(reader)
+# Only the columns reported below are loaded. Ids and other repeated labels are
+# parsed straight to categories, so unique counts and value_counts work on integer codes
+MATCH_COLUMNS = {
+    'vehicle_id': 'category',
+    'trip_id': 'category',
+    'nzta_crash_id': 'category',
+    'vehicle_type': 'category',
+    'nzta_severity': 'category',
+    'distance_to_crash': float,
+    'time_diff_minutes': float,
+    'combined_score': float,
+    'nzta_location': str,
+    'nzta_road': str,
+    'crash_datetime': str,
+    'vehicle_timestamp': str
+}
+
+matches = pd.read_csv('confirmed_crash_vehicles_5min.csv', usecols=list(MATCH_COLUMNS),
+                      dtype=MATCH_COLUMNS, keep_default_na=False)
+
+unique_vehicles = matches['vehicle_id'].nunique()
+unique_trips = matches['trip_id'].nunique()
+unique_crashes = matches['nzta_crash_id'].nunique()
+
+# Medians below are the upper middle element, found with a partial sort
+mid = len(matches) // 2
 
 print(f"\nTotal matches: {len(matches)}")
-print(f"Unique vehicles: {len(set(m['vehicle_id'] for m in matches))}")
-print(f"Unique trips: {len(set(m['trip_id'] for m in matches))}")
-print(f"Unique crashes: {len(set(m['nzta_crash_id'] for m in matches))}")
+print(f"Unique vehicles: {unique_vehicles}")
+print(f"Unique trips: {unique_trips}")
+print(f"Unique crashes: {unique_crashes}")
 
 # Severity breakdown
 print("\nCrash Severity:")
-severities = Counter([m['nzta_severity'] for m in matches])
-for severity, count in severities.most_common():
+severities = matches['nzta_severity'].value_counts()
+for severity, count in severities.items():
     pct = count / len(matches) * 100
     print(f"  {severity:20s}: {count:3d} ({pct:5.1f}%)")
 
 # Vehicle type breakdown
 print("\nConnected Vehicle Types:")
-vtypes = Counter([m['vehicle_type'] for m in matches])
-for vtype, count in vtypes.most_common():
+vtypes = matches['vehicle_type'].value_counts()
+for vtype, count in vtypes.items():
     pct = count / len(matches) * 100
     print(f"  {vtype:20s}: {count:3d} ({pct:5.1f}%)")
 
 # Distance distribution
-distances = [float(m['distance_to_crash']) for m in matches]
+distances = matches['distance_to_crash']
+distance_stats = distances.describe()
 print(f"\nDistance to crash (meters):")
-print(f"  Min: {min(distances):.2f}m")
-print(f"  Max: {max(distances):.2f}m")
-print(f"  Avg: {sum(distances)/len(distances):.2f}m")
-print(f"  Median: {sorted(distances)[len(distances)//2]:.2f}m")
+print(f"  Min: {distance_stats['min']:.2f}m")
+print(f"  Max: {distance_stats['max']:.2f}m")
+print(f"  Avg: {distance_stats['mean']:.2f}m")
+print(f"  Median: {np.partition(distances.to_numpy(), mid)[mid]:.2f}m")
 
 # Time difference distribution
-time_diffs = [float(m['time_diff_minutes']) for m in matches]
+time_diffs = matches['time_diff_minutes']
+time_diff_stats = time_diffs.describe()
 print(f"\nTime difference (minutes):")
-print(f"  Min: {min(time_diffs):.2f}min")
-print(f"  Max: {max(time_diffs):.2f}min")
-print(f"  Avg: {sum(time_diffs)/len(time_diffs):.2f}min")
-print(f"  Median: {sorted(time_diffs)[len(time_diffs)//2]:.2f}min")
+print(f"  Min: {time_diff_stats['min']:.2f}min")
+print(f"  Max: {time_diff_stats['max']:.2f}min")
+print(f"  Avg: {time_diff_stats['mean']:.2f}min")
+print(f"  Median: {np.partition(time_diffs.to_numpy(), mid)[mid]:.2f}min")
 
 # Score distribution
-scores = [float(m['combined_score']) for m in matches]
+scores = matches['combined_score']
+score_stats = scores.describe()
 print(f"\nCombined Score (0-100):")
-print(f"  Min: {min(scores):.1f}")
-print(f"  Max: {max(scores):.1f}")
-print(f"  Avg: {sum(scores)/len(scores):.1f}")
-print(f"  Median: {sorted(scores)[len(scores)//2]:.1f}")
+print(f"  Min: {score_stats['min']:.1f}")
+print(f"  Max: {score_stats['max']:.1f}")
+print(f"  Avg: {score_stats['mean']:.1f}")
+print(f"  Median: {np.partition(scores.to_numpy(), mid)[mid]:.1f}")
 
 # Top 10 examples
 print("\n" + "="*80)
 print("TOP 10 HIGHEST CONFIDENCE MATCHES")
 print("="*80)
 
-sorted_matches = sorted(matches, key=lambda x: float(x['combined_score']), reverse=True)
+top_matches = matches.nlargest(10, 'combined_score')
 
-for i, m in enumerate(sorted_matches[:10], 1):
-    print(f"\n{i}. Score: {float(m['combined_score']):.1f}/100")
+for i, m in enumerate(top_matches.to_dict('records'), 1):
+    print(f"\n{i}. Score: {m['combined_score']:.1f}/100")
     print(f"   Vehicle: {m['vehicle_id']} ({m['vehicle_type']})")
     print(f"   Crash: {m['nzta_severity']} - {m['nzta_location']} on {m['nzta_road']}")
-    print(f"   Distance: {float(m['distance_to_crash']):.1f}m | Time diff: {float(m['time_diff_minutes']):.1f}min")
+    print(f"   Distance: {m['distance_to_crash']:.1f}m | Time diff: {m['time_diff_minutes']:.1f}min")
     print(f"   Crash time: {m['crash_datetime']} | Vehicle time: {m['vehicle_timestamp']}")
 
 # Multi-crash vehicles
@@ -83,14 +105,13 @@ print("\n" + "="*80)
 print("VEHICLES MATCHED TO MULTIPLE CRASHES")
 print("="*80)
 
-vehicle_crash_counts = Counter([m['vehicle_id'] for m in matches])
-multi_crash = [(vid, count) for vid, count in vehicle_crash_counts.items() if count > 1]
+vehicle_crash_counts = matches['vehicle_id'].value_counts()
+multi_crash = vehicle_crash_counts[vehicle_crash_counts > 1]
 
-if multi_crash:
+if len(multi_crash) > 0:
     print(f"\nFound {len(multi_crash)} vehicles involved in multiple crashes:")
-    for vid, count in sorted(multi_crash, key=lambda x: x[1], reverse=True)[:10]:
-        v_matches = [m for m in matches if m['vehicle_id'] == vid]
-        vtypes = set([m['vehicle_type'] for m in v_matches])
+    for vid, count in multi_crash.head(10).items():
+        vtypes = matches.loc[matches['vehicle_id'] == vid, 'vehicle_type'].unique()
         print(f"  {vid} ({', '.join(vtypes)}): {count} crashes")
 else:
     print("\nNo vehicles matched to multiple crashes in this window")
@@ -99,10 +120,10 @@ print("\n" + "="*80)
 print("KEY INSIGHTS")
 print("="*80)
 print(f"\n✓ {len(matches)} confirmed crash-involved vehicle observations")
-print(f"✓ Average distance: {sum(distances)/len(distances):.1f}m - vehicles were AT the crash")
-print(f"✓ Average time diff: {sum(time_diffs)/len(time_diffs):.1f}min - vehicles were there WHEN it happened")
-print(f"✓ {len(set(m['vehicle_id'] for m in matches))} unique connected vehicles matched to crashes")
-print(f"✓ {len(set(m['nzta_crash_id'] for m in matches))} crashes now have identified connected vehicles")
+print(f"✓ Average distance: {distance_stats['mean']:.1f}m - vehicles were AT the crash")
+print(f"✓ Average time diff: {time_diff_stats['mean']:.1f}min - vehicles were there WHEN it happened")
+print(f"✓ {unique_vehicles} unique connected vehicles matched to crashes")
+print(f"✓ {unique_crashes} crashes now have identified connected vehicles")
 print("\nThese matches can now be used for:")
 print("  • Pre-crash driving behavior analysis")
 print("  • Speed/acceleration patterns before crashes")
@@ -3,12 +3,38 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from pathlib import Path
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+try:
+    import pyarrow
+    # Multithreaded CSV parsing when pyarrow is installed
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+# Only the columns used by the analyses below are loaded
+RESULT_COLUMNS = ['crash_id', 'crash_severity', 'crash_location', 'vehicle_id', 'trip_id',
+                  'vehicle_type', 'distance_to_crash', 'closest_timestamp', 'speed_at_point']
+
+# Kept as text whichever CSV engine is used, as the C engine and the Parquet copy
+# return it; the pyarrow engine would otherwise parse it into datetimes
+TEXT_COLUMNS = {'closest_timestamp': str}
+
 def load_results(filename='crash_vehicle_matches_full.csv'):
-    print(f"Loading results from {filename}...")
-    df = pd.read_csv(filename)
+    # Prefer the Parquet copy written by convert_csv_to_parquet.py when available
+    parquet_file = Path(filename).with_suffix('.parquet')
+    if parquet_file.exists():
+        print(f"Loading results from {parquet_file}...")
+        df = pd.read_parquet(parquet_file, columns=RESULT_COLUMNS)
+    else:
+        print(f"Loading results from {filename}...")
+        df = pd.read_csv(filename, usecols=RESULT_COLUMNS, dtype=TEXT_COLUMNS, engine=CSV_ENGINE)
+
+    # Severity has only a handful of values; as a category the repeated severity
+    # filters compare small integer codes instead of strings
+    df['crash_severity'] = df['crash_severity'].astype('category')
     print(f"Loaded {len(df):,} matches")
     return df
 
@@ -44,7 +70,18 @@ def basic_statistics(df):
     bucket_counts = df.groupby('distance_bucket')['crash_id'].nunique()
     print(bucket_counts)
 
-def high_risk_analysis(df):
+def vehicle_statistics(df):
+    """Per-vehicle aggregates shared by the high-risk and export steps (one groupby pass)"""
+    speed_numeric = pd.to_numeric(df['speed_at_point'], errors='coerce')
+    return df.assign(speed_numeric=speed_numeric).groupby('vehicle_id', sort=False, observed=True).agg(
+        num_crashes=('crash_id', 'nunique'),
+        num_trips=('trip_id', 'nunique'),
+        avg_distance=('distance_to_crash', 'mean'),
+        avg_speed=('speed_numeric', 'mean'),
+        vehicle_type=('vehicle_type', 'first')
+    )
+
+def high_risk_analysis(df, per_vehicle):
     """Identify high-risk patterns"""
     print("\n" + "="*80)
     print("HIGH-RISK ANALYSIS")
@@ -65,11 +102,7 @@ def high_risk_analysis(df):
     print(f"  Unique serious crash locations: {serious['crash_id'].nunique():,}")
 
     # Multiple crash involvement
-    vehicle_crash_counts = df.groupby('vehicle_id').agg({
-        'crash_id': 'nunique',
-        'trip_id': 'nunique'
-    }).reset_index()
-    vehicle_crash_counts.columns = ['vehicle_id', 'num_crashes', 'num_trips']
+    vehicle_crash_counts = per_vehicle[['num_crashes', 'num_trips']].reset_index()
 
     multi_crash = vehicle_crash_counts[vehicle_crash_counts['num_crashes'] > 5].sort_values('num_crashes', ascending=False)
 
@@ -84,7 +117,7 @@ def crash_hotspots(df, top_n=20):
     print(f"TOP {top_n} CRASH HOTSPOTS (Most Vehicle Traffic)")
     print("="*80)
 
-    hotspots = df.groupby(['crash_id', 'crash_location', 'crash_severity']).agg({
+    hotspots = df.groupby(['crash_id', 'crash_location', 'crash_severity'], observed=True).agg({
         'vehicle_id': 'nunique',
         'trip_id': 'count',
         'distance_to_crash': 'mean'
@@ -116,7 +149,7 @@ def speed_analysis(df):
     print(df_speed['speed_numeric'].describe())
 
     print(f"\nSpeed by crash severity:")
-    speed_by_severity = df_speed.groupby('crash_severity')['speed_numeric'].agg(['mean', 'median', 'std', 'count'])
+    speed_by_severity = df_speed.groupby('crash_severity', observed=True)['speed_numeric'].agg(['mean', 'median', 'std', 'count'])
     print(speed_by_severity)
 
     # High speed near crashes
@@ -125,7 +158,7 @@ def speed_analysis(df):
     print(f"  Count: {len(high_speed):,}")
     print(f"  Unique vehicles: {high_speed['vehicle_id'].nunique():,}")
     print(f"  Crash severity breakdown:")
-    print(high_speed['crash_severity'].value_counts())
+    print(high_speed['crash_severity'].value_counts().loc[lambda counts: counts > 0])
 
 def temporal_analysis(df):
     """Analyze temporal patterns"""
@@ -156,7 +189,7 @@ def temporal_analysis(df):
     except Exception as e:
         print(f"Error parsing timestamps: {e}")
 
-def export_high_priority_vehicles(df, output_file='high_priority_vehicles.csv'):
+def export_high_priority_vehicles(df, per_vehicle, output_file='high_priority_vehicles.csv'):
     """Export list of vehicles that should be investigated further"""
     print("\n" + "="*80)
     print("EXPORTING HIGH-PRIORITY VEHICLES")
@@ -178,28 +211,33 @@ def export_high_priority_vehicles(df, output_file='high_priority_vehicles.csv'):
     high_priority.extend(serious_vehicles)
 
     # Multiple crashes
-    vehicle_crash_counts = df.groupby('vehicle_id')['crash_id'].nunique()
-    multi_crash_vehicles = vehicle_crash_counts[vehicle_crash_counts > 5].index.tolist()
+    multi_crash_vehicles = per_vehicle.index[per_vehicle['num_crashes'] > 5].tolist()
     high_priority.extend(multi_crash_vehicles)
 
     # Unique list
     high_priority = list(set(high_priority))
 
     # Create detailed export
-    priority_df = df[df['vehicle_id'].isin(high_priority)].copy()
-
-    # Aggregate by vehicle
-    vehicle_summary = priority_df.groupby('vehicle_id').agg({
-        'crash_id': 'nunique',
-        'trip_id': 'nunique',
-        'crash_severity': lambda x: x.value_counts().to_dict(),
-        'distance_to_crash': 'mean',
-        'speed_at_point': lambda x: pd.to_numeric(x, errors='coerce').mean(),
-        'vehicle_type': 'first'
-    }).reset_index()
-
-    vehicle_summary.columns = ['vehicle_id', 'num_crash_locations', 'num_trips', 'severity_breakdown',
-                                'avg_distance_to_crashes', 'avg_speed_at_crashes', 'vehicle_type']
+    priority_df = df[df['vehicle_id'].isin(high_priority)]
+
+    # Severity counts per vehicle from a single crosstab, most frequent first
+    severity_counts = pd.crosstab(priority_df['vehicle_id'], priority_df['crash_severity']).stack()
+    severity_counts = severity_counts[severity_counts > 0].sort_values(ascending=False, kind='stable')
+    severity_breakdown = {}
+    for (vehicle_id, severity), count in severity_counts.items():
+        severity_breakdown.setdefault(vehicle_id, {})[severity] = int(count)
+    severity_breakdown = pd.Series(severity_breakdown, dtype=object)
+
+    # Per-vehicle aggregates were already computed for all vehicles
+    priority_stats = per_vehicle[per_vehicle.index.isin(high_priority)]
+    vehicle_summary = pd.DataFrame({
+        'num_crash_locations': priority_stats['num_crashes'],
+        'num_trips': priority_stats['num_trips'],
+        'severity_breakdown': severity_breakdown,
+        'avg_distance_to_crashes': priority_stats['avg_distance'],
+        'avg_speed_at_crashes': priority_stats['avg_speed'],
+        'vehicle_type': priority_stats['vehicle_type']
+    }, index=priority_stats.index).reset_index()
 
     vehicle_summary = vehicle_summary.sort_values('num_crash_locations', ascending=False)
 
@@ -214,13 +252,16 @@ def main():
     # Load results
     df = load_results('crash_vehicle_matches_full.csv')
 
+    # Per-vehicle aggregates are computed once and shared
+    per_vehicle = vehicle_statistics(df)
+
     # Run analyses
     basic_statistics(df)
-    high_risk_analysis(df)
+    high_risk_analysis(df, per_vehicle)
     crash_hotspots(df, top_n=20)
     speed_analysis(df)
     temporal_analysis(df)
-    export_high_priority_vehicles(df)
+    export_high_priority_vehicles(df, per_vehicle)
 
     print("\n" + "="*80)
     print("ANALYSIS COMPLETE")
@@ -3,33 +3,20 @@
 Fast temporal-spatial matching: filter spatially first, then temporally.
 """
 
-import csv
-import sys
-from datetime import datetime
-from collections import defaultdict
-
-csv.field_size_limit(sys.maxsize)
-
-def parse_crash_datetime(date_str, time_str):
-    try:
-        date_part = date_str.split()[0]
-        dt_str = f"{date_part} {time_str}"
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-    except:
-        return None
-
-def parse_vehicle_timestamp(ts_str):
-    try:
-        if '.' in ts_str:
-            ts_str = ts_str.split('.')[0]
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def time_delta_minutes(dt1, dt2):
-    if not dt1 or not dt2:
-        return None
-    return abs((dt1 - dt2).total_seconds() / 60)
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+def parse_crash_datetimes(dates, times):
+    """Parse crash date and time columns into a datetime64 Series (NaT if invalid)"""
+    date_part = dates.str.split().str[0]  # "2025-01-04 00:00:00" -> "2025-01-04"
+    return pd.to_datetime(date_part + ' ' + times, format="%Y-%m-%d %H:%M",
+                          errors='coerce', cache=True)
+
+def parse_vehicle_timestamps(timestamps):
+    """Parse vehicle timestamp column, dropping fractional seconds (NaT if invalid)"""
+    return pd.to_datetime(timestamps.str.split('.').str[0], format="%Y-%m-%d %H:%M:%S",
+                          errors='coerce', cache=True)
 
 print("="*80)
 print("FAST TEMPORAL-SPATIAL MATCHING")
@@ -37,139 +24,150 @@ print("="*80)
 
 # Step 1: Load crash data with timestamps
 print("\n1. Loading crash data...")
-crashes = {}
-with open('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        crash_id = row['Crash identifier']
-        crashes[crash_id] = {
-            'datetime': parse_crash_datetime(row['Crash date'], row['Crash time']),
-            'severity': row['Crash severity'],
-            'location': row.get('Locality/suburb', ''),
-            'road': row.get('Geospatial road name', '')
-        }
-
-print(f"   Loaded {len(crashes):,} crashes")
+crash_df = pd.read_csv('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv',
+                       dtype=str, keep_default_na=False)
+crash_df = crash_df.drop_duplicates('Crash identifier', keep='last')
+no_value = pd.Series('', index=crash_df.index)
+
+# Crash attributes as parallel arrays: row i describes crash_ids[i], so matches
+# look crashes up by integer position instead of hashing ids row by row
+crash_ids = pd.Index(crash_df['Crash identifier'])
+crash_dt = parse_crash_datetimes(crash_df['Crash date'], crash_df['Crash time'])
+crash_dt_str = crash_dt.dt.strftime('%Y-%m-%d %H:%M').to_numpy()
+crash_dt = crash_dt.to_numpy()
+crash_severity = crash_df['Crash severity'].to_numpy()
+crash_location = crash_df.get('Locality/suburb', no_value).to_numpy()
+crash_road = crash_df.get('Geospatial road name', no_value).to_numpy()
+
+print(f"   Loaded {len(crash_ids):,} crashes")
 
 # Step 2: Pre-filter spatial matches (close proximity only)
 print("\n2. Pre-filtering spatial matches (distance ≤ 25m)...")
-close_matches = []
-total = 0
+if Path('crash_vehicle_matches_full.parquet').exists():
+    # Parquet copy from convert_csv_to_parquet.py: the distance filter is pushed down
+    # to the reader so only close row groups are decoded
+    close_matches = pd.read_parquet('crash_vehicle_matches_full.parquet',
+                                    filters=[('distance_to_crash', '<=', 25)])
+    # Numeric columns go back to text, as the CSV branch keeps them. Values pandas
+    # wrote as floats (coordinates, distance) format back to the same text, but speed
+    # and acceleration are raw readings: 'null' comes back blank and '4.70' as '4.7',
+    # so exports from the two sources can differ in those columns
+    for col in close_matches.columns:
+        if pd.api.types.is_numeric_dtype(close_matches[col]):
+            close_matches[col] = close_matches[col].astype(str).where(close_matches[col].notna(), '')
+else:
+    close_chunks = []
+    num_close = 0
+    total = 0
+
+    # Columns are kept as strings so they are written back out exactly as read
+    reader = pd.read_csv('crash_vehicle_matches_full.csv', dtype=str, keep_default_na=False,
+                         chunksize=1000000)
+    for chunk in reader:
+        total += len(chunk)
+
+        close = chunk[chunk['distance_to_crash'].astype(float) <= 25]  # 25m threshold
+        close_chunks.append(close)
+        num_close += len(close)
 
-with open('crash_vehicle_matches_full.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        total += 1
         if total % 1000000 == 0:
-            print(f"   Processed {total//1000000}M records, found {len(close_matches):,} close matches")
+            print(f"   Processed {total//1000000}M records, found {num_close:,} close matches")
 
-        distance = float(row['distance_to_crash'])
-        if distance <= 25:  # 25m threshold
-            close_matches.append(row)
+    close_matches = pd.concat(close_chunks, ignore_index=True)
+
+    print(f"   Total processed: {total:,}")
 
-print(f"   Total processed: {total:,}")
 print(f"   Close matches (≤25m): {len(close_matches):,}")
 
 # Step 3: Apply temporal filters progressively
 print("\n3. Applying temporal filters...")
 
+# Resolve each match to its crash position once (-1 if the crash is unknown)
+crash_idx = crash_ids.get_indexer(close_matches['crash_id'])
+df = close_matches[crash_idx >= 0]
+crash_idx = crash_idx[crash_idx >= 0]
+
+# Compute time difference and spatial score once for all windows
+vehicle_ts = parse_vehicle_timestamps(df['closest_timestamp'])
+valid = ~np.isnat(crash_dt[crash_idx]) & vehicle_ts.notna().to_numpy()
+df = df[valid]
+crash_idx = crash_idx[valid]
+vehicle_ts = vehicle_ts[valid]
+
+time_diff = np.abs(crash_dt[crash_idx] - vehicle_ts.to_numpy()) / np.timedelta64(1, 'm')
+spatial_score = np.maximum(0, (25 - df['distance_to_crash'].to_numpy(dtype=float)) / 25 * 100)
+
 time_windows = [5, 10, 15, 20]
-results_by_window = {}
 
-for time_window in time_windows:
+# Windows are nested, so classify every row once by the smallest window containing it
+# (time_diff <= time_windows[i] exactly when bucket <= i) and drop rows outside them all
+bucket = np.searchsorted(time_windows, time_diff, side='left')
+in_any = bucket < len(time_windows)
+df = df[in_any]
+crash_idx = crash_idx[in_any]
+vehicle_ts = vehicle_ts[in_any]
+time_diff = time_diff[in_any]
+spatial_score = spatial_score[in_any]
+bucket = bucket[in_any]
+
+for window_num, time_window in enumerate(time_windows):
     print(f"\n   Time window: ±{time_window} minutes")
 
-    matched = []
-    for match in close_matches:
-        crash_id = str(match['crash_id'])
-
-        if crash_id not in crashes:
-            continue
-
-        crash = crashes[crash_id]
-        if not crash['datetime']:
-            continue
-
-        vehicle_ts = parse_vehicle_timestamp(match.get('closest_timestamp', ''))
-        if not vehicle_ts:
-            continue
-
-        time_diff = time_delta_minutes(crash['datetime'], vehicle_ts)
-        if time_diff is None or time_diff > time_window:
-            continue
-
-        # Calculate scores
-        spatial_dist = float(match['distance_to_crash'])
-        spatial_score = max(0, (25 - spatial_dist) / 25 * 100)
-        temporal_score = max(0, (time_window - time_diff) / time_window * 100)
-        combined_score = spatial_score * 0.6 + temporal_score * 0.4
-
-        matched.append({
-            **match,
-            'crash_datetime': crash['datetime'].strftime('%Y-%m-%d %H:%M'),
-            'vehicle_timestamp': vehicle_ts.strftime('%Y-%m-%d %H:%M:%S'),
-            'time_diff_minutes': round(time_diff, 2),
-            'spatial_score': round(spatial_score, 2),
-            'temporal_score': round(temporal_score, 2),
-            'combined_score': round(combined_score, 2),
-            'crash_severity': crash['severity'],
-            'crash_location': crash['location'],
-            'crash_road': crash['road']
-        })
+    mask = bucket <= window_num
+    temporal_score = np.maximum(0, (time_window - time_diff[mask]) / time_window * 100)
+    combined_score = spatial_score[mask] * 0.6 + temporal_score * 0.4
+
+    window_idx = crash_idx[mask]
+    matched = df[mask].assign(
+        crash_datetime=crash_dt_str[window_idx],
+        vehicle_timestamp=vehicle_ts[mask].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        time_diff_minutes=np.round(time_diff[mask], 2),
+        spatial_score=np.round(spatial_score[mask], 2),
+        temporal_score=np.round(temporal_score, 2),
+        combined_score=np.round(combined_score, 2),
+        crash_severity=crash_severity[window_idx],
+        crash_location=crash_location[window_idx],
+        crash_road=crash_road[window_idx]
+    )
 
     print(f"      Matches: {len(matched):,}")
 
-    if len(matched) > 0:
-        time_diffs = [m['time_diff_minutes'] for m in matched]
-        avg_time = sum(time_diffs) / len(time_diffs)
-        median_time = sorted(time_diffs)[len(time_diffs)//2]
-
-        distances = [float(m['distance_to_crash']) for m in matched]
-        avg_dist = sum(distances) / len(distances)
-        median_dist = sorted(distances)[len(distances)//2]
+    if len(matched) == 0:
+        continue
 
-        print(f"      Time diff - Avg: {avg_time:.2f}min, Median: {median_time:.2f}min")
-        print(f"      Distance - Avg: {avg_dist:.2f}m, Median: {median_dist:.2f}m")
+    mid = len(matched) // 2  # upper middle element, found with a partial sort
 
-        # Unique vehicles and trips
-        unique_vehicles = len(set(m['vehicle_id'] for m in matched))
-        unique_trips = len(set(m['trip_id'] for m in matched))
-        unique_crashes = len(set(m['crash_id'] for m in matched))
+    time_diffs = matched['time_diff_minutes'].to_numpy()
+    avg_time = time_diffs.mean()
+    median_time = np.partition(time_diffs, mid)[mid]
 
-        print(f"      Unique vehicles: {unique_vehicles:,}")
-        print(f"      Unique trips: {unique_trips:,}")
-        print(f"      Unique crashes: {unique_crashes:,}")
+    distances = matched['distance_to_crash'].to_numpy(dtype=float)
+    avg_dist = distances.mean()
+    median_dist = np.partition(distances, mid)[mid]
 
-    results_by_window[time_window] = matched
+    print(f"      Time diff - Avg: {avg_time:.2f}min, Median: {median_time:.2f}min")
+    print(f"      Distance - Avg: {avg_dist:.2f}m, Median: {median_dist:.2f}m")
 
-# Step 4: Export results
-print("\n" + "="*80)
-print("EXPORTING RESULTS")
-print("="*80)
+    # Unique vehicles and trips
+    unique_vehicles = matched['vehicle_id'].nunique()
+    unique_trips = matched['trip_id'].nunique()
+    unique_crashes = matched['crash_id'].nunique()
 
-for time_window, matches in results_by_window.items():
-    if len(matches) == 0:
-        continue
+    print(f"      Unique vehicles: {unique_vehicles:,}")
+    print(f"      Unique trips: {unique_trips:,}")
+    print(f"      Unique crashes: {unique_crashes:,}")
 
+    # Export each window as soon as it is scored so only one window is held at a time
     filename = f'temporal_spatial_matches_{time_window}min.csv'
-    with open(filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=matches[0].keys())
-        writer.writeheader()
-        writer.writerows(matches)
-
-    print(f"✓ {filename}: {len(matches):,} matches")
+    matched.to_csv(filename, index=False)
+    print(f"      ✓ {filename}: {len(matched):,} matches")
 
-    # Top 25% by score
-    sorted_matches = sorted(matches, key=lambda x: x['combined_score'], reverse=True)
-    high_conf = sorted_matches[:max(1, len(sorted_matches)//4)]
+    # Top 25% by score (partial selection; ties keep input order)
+    high_conf = matched.nlargest(max(1, len(matched)//4), 'combined_score', keep='first')
 
     hc_filename = f'temporal_spatial_matches_{time_window}min_high_confidence.csv'
-    with open(hc_filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=high_conf[0].keys())
-        writer.writeheader()
-        writer.writerows(high_conf)
-
-    print(f"✓ {hc_filename}: {len(high_conf):,} matches (top 25%)")
+    high_conf.to_csv(hc_filename, index=False)
+    print(f"      ✓ {hc_filename}: {len(high_conf):,} matches (top 25%)")
 
 print("\n" + "="*80)
 print("COMPLETE")
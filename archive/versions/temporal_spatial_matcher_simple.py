@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
 """
-Simple temporal-spatial matching without scipy dependency.
-Uses basic distance calculation for ~4k crashes.
+Simple temporal-spatial matching without a hard scipy dependency.
+Uses a KD-tree for nearest-crash lookup when scipy is available,
+otherwise falls back to basic distance calculation for ~4k crashes.
 """
 
 import csv
 import sys
 from datetime import datetime
-import math
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # Fallback to brute-force search if scipy not available
+    cKDTree = None
+
+try:
+    from pyproj import Transformer
+    # Built once at import; constructing one per crash dominated the load step
+    _TRANSFORMER = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
+except ImportError:
+    # Crash coordinates cannot be projected without pyproj
+    _TRANSFORMER = None
 
 csv.field_size_limit(sys.maxsize)
 
+CHUNK_SIZE = 500000
+TIME_WINDOWS = [5, 10, 15, 20]
+
 def parse_crash_datetime(date_str, time_str):
     try:
         date_part = date_str.split()[0]
@@ -19,30 +38,50 @@ def parse_crash_datetime(date_str, time_str):
     except:
         return None
 
-def parse_vehicle_timestamp(ts_str):
-    try:
-        if '.' in ts_str:
-            ts_str = ts_str.split('.')[0]
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def time_delta_minutes(dt1, dt2):
-    if not dt1 or not dt2:
-        return None
-    return abs((dt1 - dt2).total_seconds() / 60)
-
-def distance(x1, y1, x2, y2):
-    return math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-
-def lat_lon_to_nztm(lat, lon):
-    try:
-        from pyproj import Transformer
-        transformer = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
-        return transformer.transform(lon, lat)
-    except:
-        # Fallback if pyproj not available
-        return None, None
+def parse_vehicle_timestamps(timestamps):
+    """Parse vehicle timestamp column, dropping fractional seconds (NaT if invalid)"""
+    return pd.to_datetime(timestamps.str.split('.').str[0], format="%Y-%m-%d %H:%M:%S",
+                          errors='coerce', cache=True)
+
+def to_epoch_seconds(timestamps):
+    """Convert a datetime64 Series to float seconds since epoch (NaN where NaT)"""
+    return (timestamps - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
+def search_nearest_crashes(points, crash_tree, crash_xy, max_dist, block_size=1000):
+    """KD-tree (or brute-force) nearest-crash search; inf distance if none within max_dist"""
+    if crash_tree is not None:
+        return crash_tree.query(points, k=1, distance_upper_bound=max_dist)
+
+    # Brute force in blocks of rows so the distance matrix stays small. Squared
+    # distances are compared against max_dist**2; sqrt is taken only for matches
+    dists = np.full(len(points), np.inf)
+    indices = np.full(len(points), len(crash_xy))
+    max_dist_sq = max_dist * max_dist
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        dx = block[:, 0, None] - crash_xy[None, :, 0]
+        dy = block[:, 1, None] - crash_xy[None, :, 1]
+        block_dist_sq = dx * dx + dy * dy
+        nearest = block_dist_sq.argmin(axis=1)
+        min_dist_sq = block_dist_sq[np.arange(len(block)), nearest]
+        close = min_dist_sq <= max_dist_sq
+        dists[start:start + block_size][close] = np.sqrt(min_dist_sq[close])
+        indices[start:start + block_size][close] = nearest[close]
+    return dists, indices
+
+def find_nearest_crashes(points, crash_tree, crash_xy, crash_bounds, max_dist=50):
+    """Nearest NZTA crash for each (x, y) point; inf distance if none within max_dist"""
+    dists = np.full(len(points), np.inf)
+    indices = np.full(len(points), len(crash_xy))
+
+    # Points outside the crash bounding box (plus max_dist) cannot match, so only
+    # the ones inside are searched
+    x_min, y_min, x_max, y_max = crash_bounds
+    inside = ((points[:, 0] >= x_min - max_dist) & (points[:, 0] <= x_max + max_dist) &
+              (points[:, 1] >= y_min - max_dist) & (points[:, 1] <= y_max + max_dist))
+    dists[inside], indices[inside] = search_nearest_crashes(points[inside], crash_tree,
+                                                            crash_xy, max_dist)
+    return dists, indices
 
 print("="*80)
 print("TEMPORAL-SPATIAL MATCHING")
@@ -51,6 +90,7 @@ print("="*80)
 # Load NZTA crashes
 print("\n1. Loading NZTA crash data...")
 nzta_crashes = []
+crash_rows = []
 
 with open('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv', 'r') as f:
     reader = csv.DictReader(f)
@@ -59,101 +99,108 @@ with open('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv', 'r') as f
         lon = float(row['Longitude']) if row['Longitude'] else None
 
         if lat and lon:
-            x, y = lat_lon_to_nztm(lat, lon)
-            if x and y:
-                nzta_crashes.append({
-                    'crash_id': row['Crash identifier'],
-                    'datetime': parse_crash_datetime(row['Crash date'], row['Crash time']),
-                    'x': x,
-                    'y': y,
-                    'severity': row['Crash severity'],
-                    'location': row.get('Locality/suburb', ''),
-                    'road': row.get('Geospatial road name', '')
-                })
+            crash_rows.append((row, lat, lon))
+
+# Project all crash coordinates to NZTM in a single call
+if _TRANSFORMER is not None and crash_rows:
+    xs, ys = _TRANSFORMER.transform(np.array([lon for _, _, lon in crash_rows]),
+                                    np.array([lat for _, lat, _ in crash_rows]))
+else:
+    xs = ys = [None] * len(crash_rows)
+
+for (row, _, _), x, y in zip(crash_rows, xs, ys):
+    if x and y:
+        nzta_crashes.append({
+            'crash_id': row['Crash identifier'],
+            'datetime': parse_crash_datetime(row['Crash date'], row['Crash time']),
+            'x': x,
+            'y': y,
+            'severity': row['Crash severity'],
+            'location': row.get('Locality/suburb', ''),
+            'road': row.get('Geospatial road name', '')
+        })
 
 print(f"   Loaded {len(nzta_crashes):,} crashes")
 
+# Crash attributes as arrays so each chunk is matched and scored with array operations
+crash_xy = np.array([(c['x'], c['y']) for c in nzta_crashes])
+crash_bounds = (*crash_xy.min(axis=0), *crash_xy.max(axis=0))
+crash_ids = np.array([c['crash_id'] for c in nzta_crashes], dtype=object)
+crash_epoch = to_epoch_seconds(pd.Series(pd.to_datetime([c['datetime'] for c in nzta_crashes])))
+crash_dt_str = np.array([c['datetime'].strftime('%Y-%m-%d %H:%M') if c['datetime'] else ''
+                         for c in nzta_crashes], dtype=object)
+crash_severity = np.array([c['severity'] for c in nzta_crashes], dtype=object)
+crash_location = np.array([c['location'] for c in nzta_crashes], dtype=object)
+crash_road = np.array([c['road'] for c in nzta_crashes], dtype=object)
+
+# Spatial index over NZTA crash coordinates (built once)
+if cKDTree is not None:
+    crash_tree = cKDTree(crash_xy)
+    print("   Spatial index built")
+else:
+    crash_tree = None
+    print("   scipy not available - using brute-force nearest-crash search")
+
 # Load and match spatial data
 print("\n2. Matching spatial data to NZTA crashes...")
 print("   (Linking old crash IDs to new NZTA data by coordinates)")
 
-results_by_window = {5: [], 10: [], 15: [], 20: []}
+# Time-matched rows are kept once, tagged with the smallest window containing them
+# (windows are nested); per-window scores are filled in at export
+matched_chunks = []
+time_diff_chunks = []
+spatial_score_chunks = []
 total_processed = 0
 coord_matched = 0
-time_matched = {5: 0, 10: 0, 15: 0, 20: 0}
 
-with open('crash_vehicle_matches_full.csv', 'r') as f:
-    reader = csv.DictReader(f)
-
-    for row in reader:
-        total_processed += 1
-
-        if total_processed % 1000000 == 0:
-            print(f"   Processed {total_processed//1000000}M, coord-matched {coord_matched:,}")
-
-        # Skip distant matches
-        if float(row['distance_to_crash']) > 25:
-            continue
-
-        # Get crash coordinates
-        old_crash_x = float(row['crash_x'])
-        old_crash_y = float(row['crash_y'])
-
-        # Find closest NZTA crash
-        min_dist = float('inf')
-        closest_crash = None
-
-        for nzta_crash in nzta_crashes:
-            dist = distance(old_crash_x, old_crash_y, nzta_crash['x'], nzta_crash['y'])
-            if dist < min_dist:
-                min_dist = dist
-                closest_crash = nzta_crash
-
-        # Match if within 50m
-        if min_dist > 50 or not closest_crash:
-            continue
-
-        coord_matched += 1
-
-        # Check temporal match
-        nzta_datetime = closest_crash['datetime']
-        if not nzta_datetime:
-            continue
-
-        vehicle_ts = parse_vehicle_timestamp(row.get('closest_timestamp', ''))
-        if not vehicle_ts:
-            continue
-
-        time_diff = time_delta_minutes(nzta_datetime, vehicle_ts)
-        if time_diff is None:
-            continue
-
-        # Check all time windows
-        for time_window in [5, 10, 15, 20]:
-            if time_diff <= time_window:
-                # Calculate scores
-                spatial_dist = float(row['distance_to_crash'])
-                spatial_score = max(0, (25 - spatial_dist) / 25 * 100)
-                temporal_score = max(0, (time_window - time_diff) / time_window * 100)
-                combined_score = spatial_score * 0.6 + temporal_score * 0.4
-
-                match_record = {
-                    **row,
-                    'nzta_crash_id': closest_crash['crash_id'],
-                    'crash_datetime': nzta_datetime.strftime('%Y-%m-%d %H:%M'),
-                    'vehicle_timestamp': vehicle_ts.strftime('%Y-%m-%d %H:%M:%S'),
-                    'time_diff_minutes': round(time_diff, 2),
-                    'spatial_score': round(spatial_score, 2),
-                    'temporal_score': round(temporal_score, 2),
-                    'combined_score': round(combined_score, 2),
-                    'nzta_severity': closest_crash['severity'],
-                    'nzta_location': closest_crash['location'],
-                    'nzta_road': closest_crash['road'],
-                    'coord_match_distance': round(min_dist, 2)
-                }
-
-                results_by_window[time_window].append(match_record)
-                time_matched[time_window] += 1
+reader = pd.read_csv('crash_vehicle_matches_full.csv', dtype=str, keep_default_na=False,
+                     chunksize=CHUNK_SIZE)
+
+for chunk in reader:
+    total_processed += len(chunk)
+
+    # Skip distant matches
+    chunk = chunk[chunk['distance_to_crash'].astype(float) <= 25]
+
+    # Find closest NZTA crash for every row in the chunk at once (match if within 50m)
+    points = chunk[['crash_x', 'crash_y']].to_numpy(dtype=float)
+    dists, indices = find_nearest_crashes(points, crash_tree, crash_xy, crash_bounds)
+    found = np.isfinite(dists)
+    coord_matched += int(found.sum())
+
+    matched = chunk[found]
+    match_dists = dists[found]
+    crash_idx = indices[found]
+
+    # Time difference to the matched crash (NaN where either timestamp is missing)
+    vehicle_ts = parse_vehicle_timestamps(matched['closest_timestamp'])
+    time_diff = np.abs(crash_epoch[crash_idx] - to_epoch_seconds(vehicle_ts)) / 60
+    spatial_score = np.maximum(0, (25 - matched['distance_to_crash'].astype(float).to_numpy()) / 25 * 100)
+
+    # Smallest window containing each row (len(TIME_WINDOWS) if none, including NaN)
+    min_window = np.searchsorted(TIME_WINDOWS, time_diff, side='left')
+    in_any = min_window < len(TIME_WINDOWS)
+    window_idx = crash_idx[in_any]
+
+    matched_chunks.append(matched[in_any].assign(
+        nzta_crash_id=crash_ids[window_idx],
+        crash_datetime=crash_dt_str[window_idx],
+        vehicle_timestamp=vehicle_ts[in_any].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        time_diff_minutes=np.round(time_diff[in_any], 2),
+        spatial_score=np.round(spatial_score[in_any], 2),
+        temporal_score=0.0,
+        combined_score=0.0,
+        nzta_severity=crash_severity[window_idx],
+        nzta_location=crash_location[window_idx],
+        nzta_road=crash_road[window_idx],
+        coord_match_distance=np.round(match_dists[in_any], 2),
+        min_window=min_window[in_any]
+    ))
+    time_diff_chunks.append(time_diff[in_any])
+    spatial_score_chunks.append(spatial_score[in_any])
+
+    if total_processed % 1000000 == 0:
+        print(f"   Processed {total_processed//1000000}M, coord-matched {coord_matched:,}")
 
 print(f"\n   Total processed: {total_processed:,}")
 print(f"   Coordinate-matched: {coord_matched:,}")
@@ -163,43 +210,46 @@ print("\n" + "="*80)
 print("RESULTS BY TIME WINDOW")
 print("="*80)
 
-for time_window in [5, 10, 15, 20]:
-    matches = results_by_window[time_window]
+all_matches = pd.concat(matched_chunks, ignore_index=True)
+all_time_diffs = np.concatenate(time_diff_chunks)
+all_spatial_scores = np.concatenate(spatial_score_chunks)
+min_windows = all_matches.pop('min_window').to_numpy()
+
+for window_num, time_window in enumerate(TIME_WINDOWS):
+    in_window = min_windows <= window_num
+    temporal_score = np.maximum(0, (time_window - all_time_diffs[in_window]) / time_window * 100)
+    combined_score = all_spatial_scores[in_window] * 0.6 + temporal_score * 0.4
+    matches = all_matches[in_window].assign(
+        temporal_score=np.round(temporal_score, 2),
+        combined_score=np.round(combined_score, 2)
+    )
     print(f"\n±{time_window} minutes: {len(matches):,} matches")
 
     if len(matches) > 0:
         # Stats
-        time_diffs = [m['time_diff_minutes'] for m in matches]
-        distances = [float(m['distance_to_crash']) for m in matches]
-        unique_vehicles = len(set(m['vehicle_id'] for m in matches))
-        unique_trips = len(set(m['trip_id'] for m in matches))
-        unique_crashes = len(set(m['nzta_crash_id'] for m in matches))
-
-        print(f"  Time diff - Avg: {sum(time_diffs)/len(time_diffs):.2f}min, "
-              f"Median: {sorted(time_diffs)[len(time_diffs)//2]:.2f}min")
-        print(f"  Distance - Avg: {sum(distances)/len(distances):.2f}m, "
-              f"Median: {sorted(distances)[len(distances)//2]:.2f}m")
-        print(f"  Unique vehicles: {unique_vehicles:,}")
-        print(f"  Unique trips: {unique_trips:,}")
-        print(f"  Unique crashes: {unique_crashes:,}")
+        mid = len(matches) // 2  # upper middle element, found with a partial sort
+        time_diffs = matches['time_diff_minutes'].to_numpy()
+        distances = matches['distance_to_crash'].to_numpy(dtype=float)
+
+        print(f"  Time diff - Avg: {time_diffs.mean():.2f}min, "
+              f"Median: {np.partition(time_diffs, mid)[mid]:.2f}min")
+        print(f"  Distance - Avg: {distances.mean():.2f}m, "
+              f"Median: {np.partition(distances, mid)[mid]:.2f}m")
+        print(f"  Unique vehicles: {matches['vehicle_id'].nunique():,}")
+        print(f"  Unique trips: {matches['trip_id'].nunique():,}")
+        print(f"  Unique crashes: {matches['nzta_crash_id'].nunique():,}")
 
         # Export
         filename = f'confirmed_crash_vehicles_{time_window}min.csv'
-        with open(filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=matches[0].keys())
-            writer.writeheader()
-            writer.writerows(matches)
+        matches.to_csv(filename, index=False)
         print(f"  ✓ Exported: {filename}")
 
         # Top 25%
-        sorted_matches = sorted(matches, key=lambda x: x['combined_score'], reverse=True)
-        high_conf = sorted_matches[:max(1, len(sorted_matches)//4)]
+        high_conf = matches.sort_values('combined_score', ascending=False, kind='stable')
+        high_conf = high_conf.head(max(1, len(matches)//4))
 
         hc_filename = f'confirmed_crash_vehicles_{time_window}min_TOP25pct.csv'
-        with open(hc_filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=high_conf[0].keys())
-            writer.writeheader()
-            writer.writerows(high_conf)
+        high_conf.to_csv(hc_filename, index=False)
         print(f"  ✓ Exported: {hc_filename} (top 25%)")
 
 print("\n" + "="*80)
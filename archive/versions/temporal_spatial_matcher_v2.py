@@ -4,40 +4,29 @@ Temporal-spatial matching using coordinate-based crash matching.
 Handles different crash ID systems between old CAS and new NZTA data.
 """
 
-import csv
-import sys
-from datetime import datetime
 from scipy.spatial import cKDTree
-import math
-
-csv.field_size_limit(sys.maxsize)
-
-def parse_crash_datetime(date_str, time_str):
-    try:
-        date_part = date_str.split()[0]
-        dt_str = f"{date_part} {time_str}"
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-    except:
-        return None
-
-def parse_vehicle_timestamp(ts_str):
-    try:
-        if '.' in ts_str:
-            ts_str = ts_str.split('.')[0]
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def time_delta_minutes(dt1, dt2):
-    if not dt1 or not dt2:
-        return None
-    return abs((dt1 - dt2).total_seconds() / 60)
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+
+transformer_to_nztm = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
+
+def parse_crash_datetimes(dates, times):
+    """Parse crash date and time columns into a datetime64 array in one pass"""
+    date_part = pd.Series(dates, dtype=str).str.split().str[0]
+    parsed = pd.to_datetime(date_part + ' ' + pd.Series(times, dtype=str), format="%Y-%m-%d %H:%M",
+                            errors='coerce', cache=True)
+    return parsed.to_numpy()
+
+def parse_vehicle_timestamps(timestamps):
+    """Parse vehicle timestamps in one pass, dropping fractional seconds"""
+    seconds = pd.Series(timestamps, dtype=str).str.split('.').str[0]
+    parsed = pd.to_datetime(seconds, format="%Y-%m-%d %H:%M:%S", errors='coerce', cache=True)
+    return parsed.to_numpy()
 
 def lat_lon_to_nztm(lat, lon):
-    """Simple approximation - for exact coords use pyproj"""
-    from pyproj import Transformer
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
-    return transformer.transform(lon, lat)
+    """Project WGS84 lat/lon (scalars or arrays) to NZTM"""
+    return transformer_to_nztm.transform(lon, lat)
 
 print("="*80)
 print("TEMPORAL-SPATIAL MATCHING (Coordinate-based)")
@@ -45,183 +34,155 @@ print("="*80)
 
 # Step 1: Load NZTA crash data with spatial index
 print("\n1. Loading NZTA crash data...")
-nzta_crashes = []
-
-with open('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        lat = float(row['Latitude']) if row['Latitude'] else None
-        lon = float(row['Longitude']) if row['Longitude'] else None
-
-        if lat and lon:
-            x, y = lat_lon_to_nztm(lat, lon)
-            nzta_crashes.append({
-                'crash_id': row['Crash identifier'],
-                'datetime': parse_crash_datetime(row['Crash date'], row['Crash time']),
-                'x': x,
-                'y': y,
-                'lat': lat,
-                'lon': lon,
-                'severity': row['Crash severity'],
-                'location': row.get('Locality/suburb', ''),
-                'road': row.get('Geospatial road name', '')
-            })
-
-print(f"   Loaded {len(nzta_crashes):,} crashes with coordinates")
+crash_df = pd.read_csv('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv',
+                       dtype=str, keep_default_na=False)
+
+lats = pd.to_numeric(crash_df['Latitude'], errors='coerce').fillna(0).to_numpy()
+lons = pd.to_numeric(crash_df['Longitude'], errors='coerce').fillna(0).to_numpy()
+has_coords = (lats != 0) & (lons != 0)
+crash_df = crash_df[has_coords]
+lats = lats[has_coords]
+lons = lons[has_coords]
+
+# NZTA crashes are held as parallel arrays aligned with the KD-tree points
+no_value = pd.Series('', index=crash_df.index)
+nzta_crash_ids = crash_df['Crash identifier'].to_numpy()
+nzta_datetimes = parse_crash_datetimes(crash_df['Crash date'].to_numpy(), crash_df['Crash time'].to_numpy())
+nzta_severity = crash_df['Crash severity'].to_numpy()
+nzta_location = crash_df.get('Locality/suburb', no_value).to_numpy()
+nzta_road = crash_df.get('Geospatial road name', no_value).to_numpy()
+
+crash_coords = np.column_stack(lat_lon_to_nztm(lats, lons))  # C-contiguous float64, used by cKDTree as is
+
+print(f"   Loaded {len(crash_coords):,} crashes with coordinates")
 
 # Build spatial index for NZTA crashes
 print("   Building spatial index...")
-crash_coords = [[c['x'], c['y']] for c in nzta_crashes]
-crash_tree = cKDTree(crash_coords)
+crash_tree = cKDTree(crash_coords, balanced_tree=True, compact_nodes=True)
 print("   Index built")
 
 # Step 2: Load spatial matches and match to NZTA crashes by coordinates
 print("\n2. Matching old crash IDs to NZTA crashes by coordinates...")
 print("   (This links your spatial matches to the new timestamped crash data)")
 
-spatial_matches_with_nzta = []
+linked_chunks = []
 no_coord_match = 0
 matched_count = 0
 
-with open('crash_vehicle_matches_full.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    total = 0
-
-    for row in reader:
-        total += 1
-        if total % 1000000 == 0:
-            print(f"   Processed {total//1000000}M, matched {matched_count:,}")
-
-        # Skip distant matches
-        if float(row['distance_to_crash']) > 25:
-            continue
-
-        # Get crash coordinates from old data (NZTM)
-        old_crash_x = float(row['crash_x'])
-        old_crash_y = float(row['crash_y'])
-
-        # Find nearest NZTA crash (should be exact or very close)
-        distances, indices = crash_tree.query([old_crash_x, old_crash_y], k=1)
-
-        # Match if within 50m (generous tolerance for coord system differences)
-        if distances < 50:
-            nzta_crash = nzta_crashes[indices]
-            matched_count += 1
-
-            spatial_matches_with_nzta.append({
-                **row,
-                'nzta_crash_id': nzta_crash['crash_id'],
-                'nzta_datetime': nzta_crash['datetime'],
-                'nzta_severity': nzta_crash['severity'],
-                'nzta_location': nzta_crash['location'],
-                'nzta_road': nzta_crash['road'],
-                'coord_match_distance': round(distances, 2)
-            })
-        else:
-            no_coord_match += 1
+# Spatial matches are streamed in chunks and each chunk is looked up in the KD-tree in one call
+CHUNK_SIZE = 500000
+
+# Values are kept as read so they are written back out unchanged
+reader = pd.read_csv('crash_vehicle_matches_full.csv', dtype=str, keep_default_na=False,
+                     chunksize=CHUNK_SIZE)
+total = 0
+
+for chunk in reader:
+    total += len(chunk)
+
+    # Skip distant matches
+    chunk = chunk[chunk['distance_to_crash'].astype(float) <= 25]
+
+    # Link the close rows to their nearest NZTA crash in one KD-tree query
+    points = np.ascontiguousarray(chunk[['crash_x', 'crash_y']].to_numpy(dtype=float))
+    distances, indices = crash_tree.query(points, k=1, workers=-1)  # query threads release the GIL
+
+    # Match if within 50m (generous tolerance for coord system differences)
+    close = distances < 50
+    idx = indices[close]
+    matched_count += int(close.sum())
+    no_coord_match += int((~close).sum())
+
+    linked_chunks.append(chunk[close].assign(
+        nzta_crash_id=nzta_crash_ids[idx],
+        nzta_datetime=nzta_datetimes[idx],
+        nzta_severity=nzta_severity[idx],
+        nzta_location=nzta_location[idx],
+        nzta_road=nzta_road[idx],
+        coord_match_distance=np.round(distances[close], 2)
+    ))
+
+    if total % 1000000 == 0:
+        print(f"   Processed {total//1000000}M, matched {matched_count:,}")
+
+spatial_matches_with_nzta = pd.concat(linked_chunks, ignore_index=True)
 
 print(f"   Total close spatial matches: {matched_count + no_coord_match:,}")
 print(f"   Matched to NZTA crashes: {matched_count:,}")
 print(f"   No coordinate match: {no_coord_match:,}")
 
-# Step 3: Apply temporal filters
+# Step 3: Apply temporal filters and export each window
 print("\n3. Applying temporal filters...")
 
 time_windows = [5, 10, 15, 20]
-results_by_window = {}
+
+# Time difference and spatial score are computed once for every match, shared by all windows
+vehicle_timestamps = parse_vehicle_timestamps(spatial_matches_with_nzta['closest_timestamp'])
+crash_datetimes = spatial_matches_with_nzta['nzta_datetime'].to_numpy()
+has_timestamp = ~(np.isnat(crash_datetimes) | np.isnat(vehicle_timestamps))
+no_timestamp = int((~has_timestamp).sum())
+
+time_diff = np.abs(crash_datetimes - vehicle_timestamps) / np.timedelta64(1, 'm')  # NaN where missing
+spatial_dist = spatial_matches_with_nzta['distance_to_crash'].astype(float).to_numpy()
+spatial_score = np.maximum(0, (25 - spatial_dist) / 25 * 100)
 
 for time_window in time_windows:
     print(f"\n   Time window: ±{time_window} minutes")
 
-    matched = []
-    no_timestamp = 0
-
-    for match in spatial_matches_with_nzta:
-        nzta_datetime = match['nzta_datetime']
-        if not nzta_datetime:
-            no_timestamp += 1
-            continue
-
-        vehicle_ts = parse_vehicle_timestamp(match.get('closest_timestamp', ''))
-        if not vehicle_ts:
-            no_timestamp += 1
-            continue
-
-        time_diff = time_delta_minutes(nzta_datetime, vehicle_ts)
-        if time_diff is None or time_diff > time_window:
-            continue
-
-        # Calculate scores
-        spatial_dist = float(match['distance_to_crash'])
-        spatial_score = max(0, (25 - spatial_dist) / 25 * 100)
-        temporal_score = max(0, (time_window - time_diff) / time_window * 100)
-        combined_score = spatial_score * 0.6 + temporal_score * 0.4
-
-        matched.append({
-            **match,
-            'crash_datetime': nzta_datetime.strftime('%Y-%m-%d %H:%M'),
-            'vehicle_timestamp': vehicle_ts.strftime('%Y-%m-%d %H:%M:%S'),
-            'time_diff_minutes': round(time_diff, 2),
-            'spatial_score': round(spatial_score, 2),
-            'temporal_score': round(temporal_score, 2),
-            'combined_score': round(combined_score, 2)
-        })
+    in_window = time_diff <= time_window
+    window_diff = time_diff[in_window]
+    temporal_score = np.maximum(0, (time_window - window_diff) / time_window * 100)
+    combined_score = spatial_score[in_window] * 0.6 + temporal_score * 0.4
+
+    matched = spatial_matches_with_nzta[in_window]
+    matched = matched.assign(
+        crash_datetime=matched['nzta_datetime'].dt.strftime('%Y-%m-%d %H:%M'),
+        vehicle_timestamp=pd.Series(vehicle_timestamps[in_window], index=matched.index)
+                            .dt.strftime('%Y-%m-%d %H:%M:%S'),
+        time_diff_minutes=np.round(window_diff, 2),
+        spatial_score=np.round(spatial_score[in_window], 2),
+        temporal_score=np.round(temporal_score, 2),
+        combined_score=np.round(combined_score, 2)
+    )
 
     print(f"      Matches: {len(matched):,}")
     print(f"      Skipped (no timestamp): {no_timestamp:,}")
 
-    if len(matched) > 0:
-        time_diffs = [m['time_diff_minutes'] for m in matched]
-        avg_time = sum(time_diffs) / len(time_diffs)
-        median_time = sorted(time_diffs)[len(time_diffs)//2]
-
-        distances = [float(m['distance_to_crash']) for m in matched]
-        avg_dist = sum(distances) / len(distances)
-        median_dist = sorted(distances)[len(distances)//2]
+    if len(matched) == 0:
+        continue
 
-        print(f"      Time diff - Avg: {avg_time:.2f}min, Median: {median_time:.2f}min")
-        print(f"      Distance - Avg: {avg_dist:.2f}m, Median: {median_dist:.2f}m")
+    mid = len(matched) // 2  # upper middle element, found with a partial sort
 
-        # Unique counts
-        unique_vehicles = len(set(m['vehicle_id'] for m in matched))
-        unique_trips = len(set(m['trip_id'] for m in matched))
-        unique_crashes = len(set(m['nzta_crash_id'] for m in matched))
+    avg_time = matched['time_diff_minutes'].mean()
+    median_time = np.partition(matched['time_diff_minutes'].to_numpy(), mid)[mid]
 
-        print(f"      Unique vehicles: {unique_vehicles:,}")
-        print(f"      Unique trips: {unique_trips:,}")
-        print(f"      Unique crashes: {unique_crashes:,}")
+    distances = spatial_dist[in_window]
+    avg_dist = distances.mean()
+    median_dist = np.partition(distances, mid)[mid]
 
-    results_by_window[time_window] = matched
+    print(f"      Time diff - Avg: {avg_time:.2f}min, Median: {median_time:.2f}min")
+    print(f"      Distance - Avg: {avg_dist:.2f}m, Median: {median_dist:.2f}m")
 
-# Step 4: Export
-print("\n" + "="*80)
-print("EXPORTING RESULTS")
-print("="*80)
+    # Unique counts
+    unique_vehicles = matched['vehicle_id'].nunique()
+    unique_trips = matched['trip_id'].nunique()
+    unique_crashes = matched['nzta_crash_id'].nunique()
 
-for time_window, matches in results_by_window.items():
-    if len(matches) == 0:
-        print(f"  {time_window}min: No matches")
-        continue
+    print(f"      Unique vehicles: {unique_vehicles:,}")
+    print(f"      Unique trips: {unique_trips:,}")
+    print(f"      Unique crashes: {unique_crashes:,}")
 
+    # Export each window as soon as it is scored so only one window is held at a time
     filename = f'confirmed_crash_vehicles_{time_window}min.csv'
-    with open(filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=matches[0].keys())
-        writer.writeheader()
-        writer.writerows(matches)
-
-    print(f"✓ {filename}: {len(matches):,} matches")
+    matched.to_csv(filename, index=False)
+    print(f"      ✓ {filename}: {len(matched):,} matches")
 
     # Top 25% by score
-    sorted_matches = sorted(matches, key=lambda x: x['combined_score'], reverse=True)
-    high_conf = sorted_matches[:max(1, len(sorted_matches)//4)]
+    high_conf = matched.nlargest(max(1, len(matched)//4), 'combined_score', keep='first')
 
     hc_filename = f'confirmed_crash_vehicles_{time_window}min_TOP25pct.csv'
-    with open(hc_filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=high_conf[0].keys())
-        writer.writeheader()
-        writer.writerows(high_conf)
-
-    print(f"✓ {hc_filename}: {len(high_conf):,} matches (top 25%)")
+    high_conf.to_csv(hc_filename, index=False)
+    print(f"      ✓ {hc_filename}: {len(high_conf):,} matches (top 25%)")
 
 print("\n" + "="*80)
 print("SUCCESS!")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+One-shot conversion of the spatial match CSV to Parquet.
+
+Reading crash_vehicle_matches_full.csv (~1.5 GB) costs a full CSV parse on every
+run. This streams it once into crash_vehicle_matches_full.parquet, which
+analyze_results.py, identify_crash_involved_vehicles.py and the fast temporal
+matcher pick up automatically when it exists. Requires pyarrow.
+"""
+
+import csv
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+INPUT_FILE = 'crash_vehicle_matches_full.csv'
+OUTPUT_FILE = 'crash_vehicle_matches_full.parquet'
+
+# Numeric columns get real types so filters like distance_to_crash <= 25 can use
+# row group statistics; everything else stays a string exactly as written. Typed
+# values lose their original text, e.g. a 'null' speed reading becomes missing
+NUMERIC_COLUMNS = {
+    'crash_x': pa.float64(),
+    'crash_y': pa.float64(),
+    'distance_to_crash': pa.float64(),
+    'closest_point_idx': pa.int64(),
+    'speed_at_point': pa.float64(),
+    'x_accel_at_point': pa.float64(),
+    'trip_speed_max': pa.float64(),
+    'trip_speed_avg': pa.float64(),
+}
+
+def main():
+    print("="*80)
+    print("CONVERTING SPATIAL MATCHES TO PARQUET")
+    print("="*80)
+
+    with open(INPUT_FILE, 'r', newline='') as f:
+        header = next(csv.reader(f))
+
+    column_types = {col: NUMERIC_COLUMNS.get(col, pa.string()) for col in header}
+
+    reader = pv.open_csv(
+        INPUT_FILE,
+        read_options=pv.ReadOptions(block_size=64 << 20),
+        convert_options=pv.ConvertOptions(column_types=column_types)
+    )
+
+    total = 0
+    with pq.ParquetWriter(OUTPUT_FILE, reader.schema, compression='zstd') as writer:
+        for batch in reader:
+            writer.write_batch(batch, row_group_size=1000000)
+            total += batch.num_rows
+            print(f"  Converted {total:,} records...")
+
+    print(f"\nWrote {total:,} records to {OUTPUT_FILE}")
+
+if __name__ == "__main__":
+    main()
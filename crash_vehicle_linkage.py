@@ -12,6 +12,7 @@ from pyproj import Transformer
 from shapely.geometry import Point, LineString
 from shapely.ops import transform
 from scipy.spatial import cKDTree
+from paths import parse_points
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -36,8 +37,9 @@ class CrashVehicleLinkage:
         print(self.crashes['crashSeverity'].value_counts())
 
         print("Building spatial index...")
-        crash_coords = self.crashes[['X', 'Y']].values
-        self.crash_tree = cKDTree(crash_coords)
+        # cKDTree keeps float64 points; handing it a C-contiguous array avoids an internal copy
+        crash_coords = np.ascontiguousarray(self.crashes[['X', 'Y']].to_numpy(dtype=np.float64))
+        self.crash_tree = cKDTree(crash_coords, balanced_tree=True, compact_nodes=True)
         print("Spatial index built")
 
         return self.crashes
@@ -48,51 +50,52 @@ class CrashVehicleLinkage:
         return self.vehicle_files
 
     def parse_path_string(self, path_str):
+        """Parse a RawPath string into an (N, 2) array of lon/lat"""
         if pd.isna(path_str) or path_str == '':
-            return []
+            return np.empty((0, 2))
 
-        try:
-            points = []
-            pairs = path_str.split(',')
-            for pair in pairs:
-                coords = pair.strip().split()
-                if len(coords) == 2:
-                    lon, lat = float(coords[0]), float(coords[1])
-                    points.append((lon, lat))
-            return points
-        except:
-            return []
+        return parse_points(path_str)[0]
 
     def convert_path_to_nztm(self, path_points):
-        nztm_points = []
-        for lon, lat in path_points:
-            x, y = transformer_to_nztm.transform(lon, lat)
-            nztm_points.append((x, y))
-        return nztm_points
+        x, y = transformer_to_nztm.transform(path_points[:, 0], path_points[:, 1])
+        return np.column_stack((x, y))
 
     def point_to_point_distance(self, x1, y1, x2, y2):
         return np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
 
     def find_nearby_crashes(self, path_points_nztm):
-        if not path_points_nztm:
+        if len(path_points_nztm) == 0:
             return []
 
-        path_array = np.array(path_points_nztm)
-        distances, indices = self.crash_tree.query(
+        path_array = np.asarray(path_points_nztm)
+        neighbours = self.crash_tree.query_ball_point(
             path_array,
-            k=10,
-            distance_upper_bound=self.buffer_distance
+            r=self.buffer_distance,
+            return_sorted=False,
+            workers=-1
         )
 
-        crash_matches = {}
+        # Flatten to one (point, crash) pair per in-radius candidate
+        counts = np.fromiter(map(len, neighbours), dtype=np.intp, count=len(neighbours))
+        if counts.sum() == 0:
+            return []
+        point_idx = np.repeat(np.arange(len(path_array)), counts)
+        crash_idx = np.concatenate(neighbours).astype(np.intp)
+        offsets = self.crash_tree.data[crash_idx] - path_array[point_idx]
+        dists = np.sqrt((offsets ** 2).sum(axis=1))
+
+        # Closest point per crash (earliest point on ties)
+        order = np.lexsort((point_idx, dists, crash_idx))
+        crash_sorted = crash_idx[order]
+        first = np.flatnonzero(np.r_[True, crash_sorted[1:] != crash_sorted[:-1]])
+        best = order[first]
 
-        for point_idx, (dists, crash_indices) in enumerate(zip(distances, indices)):
-            for dist, crash_idx in zip(dists, crash_indices):
-                if dist <= self.buffer_distance and crash_idx < len(self.crashes):
-                    if crash_idx not in crash_matches or dist < crash_matches[crash_idx][0]:
-                        crash_matches[crash_idx] = (dist, point_idx)
+        # Report crashes in the order the path first reaches them
+        reach_order = np.lexsort((dists, point_idx))
+        _, first_reach = np.unique(crash_idx[reach_order], return_index=True)
+        best = best[np.argsort(first_reach, kind='stable')]
 
-        return [(crash_idx, dist, point_idx) for crash_idx, (dist, point_idx) in crash_matches.items()]
+        return list(zip(crash_idx[best], dists[best], point_idx[best]))
 
     def process_vehicle_file(self, vehicle_file, max_records=None):
         print(f"\nProcessing: {vehicle_file.name}")
@@ -101,12 +104,26 @@ class CrashVehicleLinkage:
 
         matches_in_file = []
 
-        for idx, row in df_vehicles.iterrows():
+        # Plain column arrays, indexed per trip (no per-row Series)
+        missing = pd.Series(None, index=df_vehicles.index, dtype=object)
+        raw_paths = df_vehicles['RawPath'].to_numpy()
+        timestamp_paths = df_vehicles['TimestampPath'].to_numpy()
+        speed_paths = df_vehicles['SpeedPath'].to_numpy()
+        x_accel_paths = df_vehicles['XAccPath'].to_numpy()
+        vehicle_ids = df_vehicles['VehicleID'].to_numpy()
+        trip_ids = df_vehicles['TripID'].to_numpy()
+        vehicle_types = df_vehicles['VehicleType'].to_numpy()
+        start_dates = df_vehicles['StartDate'].to_numpy()
+        end_dates = df_vehicles['EndDate'].to_numpy()
+        speed_maxes = df_vehicles.get('SpeedMax', missing).to_numpy()
+        speed_avgs = df_vehicles.get('SpeedAvg', missing).to_numpy()
+
+        for idx in range(len(df_vehicles)):
             if idx % 500 == 0 and idx > 0:
                 print(f"  Processed {idx}/{len(df_vehicles)} trips, {len(matches_in_file)} matches")
 
-            raw_path = self.parse_path_string(row['RawPath'])
-            if not raw_path:
+            raw_path = self.parse_path_string(raw_paths[idx])
+            if len(raw_path) == 0:
                 continue
 
             path_nztm = self.convert_path_to_nztm(raw_path)
@@ -114,9 +131,9 @@ class CrashVehicleLinkage:
 
             for crash_idx, min_dist, closest_point_idx in nearby_crashes:
                 crash = self.crashes.iloc[crash_idx]
-                timestamps = row['TimestampPath'].split(',') if pd.notna(row['TimestampPath']) else []
-                speeds = row['SpeedPath'].split(',') if pd.notna(row['SpeedPath']) else []
-                x_accel = row['XAccPath'].split(',') if pd.notna(row['XAccPath']) else []
+                timestamps = timestamp_paths[idx].split(',') if pd.notna(timestamp_paths[idx]) else []
+                speeds = speed_paths[idx].split(',') if pd.notna(speed_paths[idx]) else []
+                x_accel = x_accel_paths[idx].split(',') if pd.notna(x_accel_paths[idx]) else []
 
                 match = {
                     'crash_id': crash.name,
@@ -124,18 +141,18 @@ class CrashVehicleLinkage:
                     'crash_y': crash['Y'],
                     'crash_severity': crash['crashSeverity'],
                     'crash_location': crash.get('crashLocation1', 'Unknown'),
-                    'vehicle_id': row['VehicleID'],
-                    'trip_id': row['TripID'],
-                    'vehicle_type': row['VehicleType'],
+                    'vehicle_id': vehicle_ids[idx],
+                    'trip_id': trip_ids[idx],
+                    'vehicle_type': vehicle_types[idx],
                     'distance_to_crash': min_dist,
-                    'trip_start': row['StartDate'],
-                    'trip_end': row['EndDate'],
+                    'trip_start': start_dates[idx],
+                    'trip_end': end_dates[idx],
                     'closest_point_idx': closest_point_idx,
                     'closest_timestamp': timestamps[closest_point_idx] if closest_point_idx < len(timestamps) else None,
                     'speed_at_point': speeds[closest_point_idx] if closest_point_idx < len(speeds) else None,
                     'x_accel_at_point': x_accel[closest_point_idx] if closest_point_idx < len(x_accel) else None,
-                    'trip_speed_max': row.get('SpeedMax', None),
-                    'trip_speed_avg': row.get('SpeedAvg', None),
+                    'trip_speed_max': speed_maxes[idx],
+                    'trip_speed_avg': speed_avgs[idx],
                 }
 
                 matches_in_file.append(match)
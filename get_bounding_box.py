@@ -1,46 +1,52 @@
 #!/usr/bin/env python3
 """Extract bounding box from vehicle GPS data"""
 
-import csv
 from pathlib import Path
-import sys
-
-csv.field_size_limit(sys.maxsize)
+import numpy as np
+import pandas as pd
+from paths import parse_points
 
 vehicle_dir = Path('data/connected_vehicle')
 files = list(vehicle_dir.glob('support.NZ_report_withOD-*.csv'))[:10]
 
 print(f"Sampling {len(files)} files to find bounding box...\n")
 
-all_lats = []
-all_lons = []
+def sample_points(paths):
+    """First 5 points of every trip in a chunk of RawPath strings"""
+    samples = paths.str.split(',', n=5).str[:5].str.join(',')
+
+    # The batch is only trusted when every trip has two values per point; a point
+    # with 1 or 3 values would shift every later lon/lat in the chunk
+    if (samples.str.replace(',', ' ').str.split().str.len() == 2 * (samples.str.count(',') + 1)).all():
+        return parse_points(','.join(samples))[0]
+
+    # Parse trip by trip, so only malformed points are dropped
+    return np.concatenate([parse_points(sample)[0] for sample in samples] + [np.empty((0, 2))])
+
+# Running bounds, only a chunk of points is held at a time
+num_points = 0
+lat_min = lon_min = np.inf
+lat_max = lon_max = -np.inf
 
 for f in files:
     print(f"Processing {f.name}...")
-    with open(f, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            path_str = row.get('RawPath', '')
-            if not path_str:
-                continue
-
-            try:
-                pairs = path_str.split(',')
-                for pair in pairs[:5]:  # Sample first 5 points per trip
-                    coords = pair.strip().split()
-                    if len(coords) == 2:
-                        lon, lat = float(coords[0]), float(coords[1])
-                        all_lons.append(lon)
-                        all_lats.append(lat)
-            except:
-                continue
-
-print(f"\nAnalyzed {len(all_lats):,} GPS points")
+    for chunk in pd.read_csv(f, usecols=['RawPath'], dtype=str, chunksize=10000):
+        points = sample_points(chunk['RawPath'].dropna())  # Sample first 5 points per trip
+        if len(points) == 0:
+            continue
+
+        num_points += len(points)
+        lon_min = min(lon_min, points[:, 0].min())
+        lon_max = max(lon_max, points[:, 0].max())
+        lat_min = min(lat_min, points[:, 1].min())
+        lat_max = max(lat_max, points[:, 1].max())
+
+print(f"\nAnalyzed {num_points:,} GPS points")
 print(f"\nBounding Box:")
-print(f"  Latitude:  {min(all_lats):.6f} to {max(all_lats):.6f}")
-print(f"  Longitude: {min(all_lons):.6f} to {max(all_lons):.6f}")
+print(f"  Latitude:  {lat_min:.6f} to {lat_max:.6f}")
+print(f"  Longitude: {lon_min:.6f} to {lon_max:.6f}")
 print(f"\nFor NZTA query:")
-print(f"  South: {min(all_lats):.4f}")
-print(f"  North: {max(all_lats):.4f}")
-print(f"  West:  {min(all_lons):.4f}")
-print(f"  East:  {max(all_lons):.4f}")
+print(f"  South: {lat_min:.4f}")
+print(f"  North: {lat_max:.4f}")
+print(f"  West:  {lon_min:.4f}")
+print(f"  East:  {lon_max:.4f}")
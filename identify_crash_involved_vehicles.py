@@ -6,10 +6,37 @@ Uses proximity, speed, deceleration, and crash severity.
 
 import pandas as pd
 import numpy as np
+from pathlib import Path
+
+try:
+    import pyarrow
+    # Multithreaded CSV parsing when pyarrow is installed
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+# Timestamps only pass through to the exports. Read as text they are written back
+# exactly as in the CSV; the pyarrow engine would otherwise parse and reformat them
+TEXT_COLUMNS = {'trip_start': str, 'trip_end': str, 'closest_timestamp': str}
+
+# Severity bonus by crash_severity category code; the trailing 0 is picked up
+# by code -1 (severity missing or not one of the categories)
+SEVERITY_CATEGORIES = ['Fatal Crash', 'Serious Crash', 'Minor Crash', 'Non-Injury Crash']
+SEVERITY_BONUS = np.array([10, 7, 3, 0, 0])
+
+# Columns written to the subset exports; the full scoring breakdown (numeric
+# copies, component scores, score_category) is only kept in the all-candidates file
+EXPORT_COLUMNS = ['crash_id', 'crash_severity', 'crash_location', 'vehicle_id', 'trip_id', 'vehicle_type',
+                  'distance_to_crash', 'closest_timestamp', 'speed_at_point', 'x_accel_at_point',
+                  'involvement_score']
 
 def load_data():
     print("Loading crash match data...")
-    df = pd.read_csv('crash_vehicle_matches_full.csv')
+    # Prefer the Parquet copy written by convert_csv_to_parquet.py when available
+    if Path('crash_vehicle_matches_full.parquet').exists():
+        df = pd.read_parquet('crash_vehicle_matches_full.parquet')
+    else:
+        df = pd.read_csv('crash_vehicle_matches_full.csv', dtype=TEXT_COLUMNS, engine=CSV_ENGINE)
     print(f"Loaded {len(df):,} records\n")
     return df
 
@@ -22,15 +49,38 @@ def calculate_involvement_score(df):
     df['speed_numeric'] = pd.to_numeric(df['speed_at_point'], errors='coerce')
     df['x_accel_numeric'] = pd.to_numeric(df['x_accel_at_point'], errors='coerce')
 
-    df['distance_score'] = ((25 - df['distance_to_crash']) / 25 * 30).clip(0, 30)
-    df['speed_score'] = ((30 - df['speed_numeric'].clip(0, 30)) / 30 * 40).clip(0, 40)
-    df['decel_score'] = ((-df['x_accel_numeric'].fillna(0)).clip(-10, 10) + 10) / 20 * 20
-
-    severity_bonus = {'Fatal Crash': 10, 'Serious Crash': 7, 'Minor Crash': 3, 'Non-Injury Crash': 0}
-    df['severity_score'] = df['crash_severity'].map(severity_bonus).fillna(0)
-
-    df['involvement_score'] = (df['distance_score'] + df['speed_score'] +
-                                df['decel_score'] + df['severity_score'])
+    # Each component is computed in place on one float64 buffer rather than
+    # allocating a new Series per arithmetic step
+    distance = df['distance_to_crash'].to_numpy(dtype=np.float64)
+    distance_score = np.subtract(25, distance)
+    distance_score /= 25
+    distance_score *= 30
+    df['distance_score'] = np.clip(distance_score, 0, 30, out=distance_score)
+
+    speed_score = np.clip(df['speed_numeric'].to_numpy(dtype=np.float64), 0, 30)
+    np.subtract(30, speed_score, out=speed_score)
+    speed_score /= 30
+    speed_score *= 40
+    df['speed_score'] = np.clip(speed_score, 0, 40, out=speed_score)
+
+    decel_score = np.negative(df['x_accel_numeric'].fillna(0).to_numpy(dtype=np.float64))
+    np.clip(decel_score, -10, 10, out=decel_score)
+    decel_score += 10
+    decel_score /= 20
+    decel_score *= 20
+    df['decel_score'] = decel_score
+
+    codes = pd.Categorical(df['crash_severity'], categories=SEVERITY_CATEGORIES).codes
+    severity_score = SEVERITY_BONUS[codes]
+    if (codes < 0).any():
+        # Unmatched severities used to come back as NaN, which made the column float
+        severity_score = severity_score.astype(np.float64)
+    df['severity_score'] = severity_score
+
+    involvement_score = distance_score + speed_score
+    involvement_score += decel_score
+    involvement_score += df['severity_score'].to_numpy(dtype=np.float64)
+    df['involvement_score'] = involvement_score
 
     return df
 
@@ -59,11 +109,17 @@ def analyze_score_distribution(df):
     labels = ['0-40 (Low)', '40-50 (Medium-Low)', '50-60 (Medium)',
               '60-70 (Medium-High)', '70-80 (High)', '80-90 (Very High)', '90-100 (Extreme)']
 
-    df['score_category'] = pd.cut(df['involvement_score'], bins=bins, labels=labels, include_lowest=True)
+    # Same right-closed bins as pd.cut(..., include_lowest=True): a binary search
+    # per score, with scores outside 0-100 (or NaN) left uncategorised
+    scores = df['involvement_score'].to_numpy()
+    codes = np.digitize(scores, bins, right=True) - 1
+    codes[scores == bins[0]] = 0
+    codes[(codes < 0) | (codes >= len(labels))] = -1
+    df['score_category'] = pd.Categorical.from_codes(codes, categories=labels, ordered=True)
 
-    score_dist = df['score_category'].value_counts().sort_index()
+    score_dist = np.bincount(codes[codes >= 0], minlength=len(labels))
     print("Score distribution:")
-    for category, count in score_dist.items():
+    for category, count in zip(labels, score_dist):
         pct = count / len(df) * 100
         print(f"  {category:25s}: {count:10,} ({pct:5.2f}%)")
 
@@ -100,14 +156,30 @@ def get_top_candidates_per_crash(candidates, n_per_crash=3):
     print("="*80)
     print()
 
-    # Get top candidates per crash
-    top_per_crash = candidates.sort_values('involvement_score', ascending=False).groupby('crash_id').head(n_per_crash)
+    # Rank within crash on just the two key columns, keep the first n of each
+    # crash, and only sort the (much smaller) selection by score
+    ranked = candidates[['crash_id', 'involvement_score']].assign(_pos=np.arange(len(candidates)))
+    ranked = ranked.sort_values(['crash_id', 'involvement_score'], ascending=[True, False], kind='stable')
+    keep = np.sort(ranked['_pos'].to_numpy()[ranked.groupby('crash_id').cumcount().to_numpy() < n_per_crash])
+    top_per_crash = candidates.iloc[keep].sort_values('involvement_score', ascending=False, kind='stable')
 
     print(f"Selected {len(top_per_crash):,} top candidates across {top_per_crash['crash_id'].nunique():,} crashes")
     print()
 
     return top_per_crash
 
+def top_n_positions(scores, n):
+    """Positions of the n highest scores, highest first with ties in original order (like nlargest)"""
+    if n >= len(scores):
+        return np.argsort(-scores, kind='stable')
+
+    # Quickselect the n-th highest score instead of sorting everything
+    threshold = np.partition(scores, len(scores) - n)[len(scores) - n]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[:n - len(above)]
+    positions = np.sort(np.concatenate([above, ties]))
+    return positions[np.argsort(-scores[positions], kind='stable')]
+
 def show_examples(candidates, n=30):
     """Show top examples"""
 
@@ -116,7 +188,7 @@ def show_examples(candidates, n=30):
     print("="*80)
     print()
 
-    top = candidates.nlargest(n, 'involvement_score')
+    top = candidates.iloc[top_n_positions(candidates['involvement_score'].to_numpy(), n)]
 
     for idx, (_, row) in enumerate(top.iterrows(), 1):
         print(f"{idx}. Score: {row['involvement_score']:.1f}/100")
@@ -134,6 +206,15 @@ def export_results(candidates, top_per_crash):
     print("="*80)
     print()
 
+    # Rank by score once; each confidence threshold is then a binary search
+    # into the ranking (positions are re-sorted to keep the file row order)
+    order = np.argsort(-candidates['involvement_score'].to_numpy(), kind='stable')
+    neg_ranked = -candidates['involvement_score'].to_numpy()[order]
+    very_high = np.sort(order[:np.searchsorted(neg_ranked, -70, side='right')])
+    extreme = np.sort(order[:np.searchsorted(neg_ranked, -80, side='right')])
+    fatal_serious = np.flatnonzero(candidates['crash_severity'].isin(['Fatal Crash', 'Serious Crash']))
+    exports = candidates[EXPORT_COLUMNS]
+
     # All high-scoring candidates
     output_file = 'crash_involved_candidates_scored.csv'
     candidates.to_csv(output_file, index=False)
@@ -141,45 +222,48 @@ def export_results(candidates, top_per_crash):
     print(f"  {len(candidates):,} records")
 
     # Very high confidence (score >= 70)
-    very_high = candidates[candidates['involvement_score'] >= 70]
     high_file = 'crash_involved_very_high_confidence.csv'
-    very_high.to_csv(high_file, index=False)
+    exports.iloc[very_high].to_csv(high_file, index=False)
     print(f"✓ Very high confidence (score >= 70): {high_file}")
     print(f"  {len(very_high):,} records")
 
     # Extreme confidence (score >= 80)
-    extreme = candidates[candidates['involvement_score'] >= 80]
     extreme_file = 'crash_involved_extreme_confidence.csv'
-    extreme.to_csv(extreme_file, index=False)
+    exports.iloc[extreme].to_csv(extreme_file, index=False)
     print(f"✓ Extreme confidence (score >= 80): {extreme_file}")
     print(f"  {len(extreme):,} records")
 
     # Top per crash
     top_file = 'crash_involved_top_per_crash.csv'
-    top_per_crash.to_csv(top_file, index=False)
+    top_per_crash[EXPORT_COLUMNS].to_csv(top_file, index=False)
     print(f"✓ Top candidates per crash: {top_file}")
     print(f"  {len(top_per_crash):,} records across {top_per_crash['crash_id'].nunique():,} crashes")
 
     # Fatal/serious only
-    fatal_serious = candidates[candidates['crash_severity'].isin(['Fatal Crash', 'Serious Crash'])]
     fs_file = 'crash_involved_fatal_serious.csv'
-    fatal_serious.to_csv(fs_file, index=False)
+    exports.iloc[fatal_serious].to_csv(fs_file, index=False)
     print(f"✓ Fatal & serious crashes only: {fs_file}")
     print(f"  {len(fatal_serious):,} records")
 
     print()
 
     # Vehicle summary
-    vehicle_summary = candidates.groupby('vehicle_id').agg({
-        'trip_id': 'nunique',
-        'crash_id': 'nunique',
-        'involvement_score': ['mean', 'max'],
-        'vehicle_type': 'first',
-        'crash_severity': lambda x: x.value_counts().to_dict()
-    }).reset_index()
-
-    vehicle_summary.columns = ['vehicle_id', 'num_trips', 'num_crashes',
-                                'avg_score', 'max_score', 'vehicle_type', 'crash_severities']
+    vehicle_summary = candidates.groupby('vehicle_id').agg(
+        num_trips=('trip_id', 'nunique'),
+        num_crashes=('crash_id', 'nunique'),
+        avg_score=('involvement_score', 'mean'),
+        max_score=('involvement_score', 'max'),
+        vehicle_type=('vehicle_type', 'first')
+    ).reset_index()
+
+    # Severity counts per vehicle from one grouped size (no Python callback per
+    # group), ordered most common first like value_counts
+    severity_counts = candidates.groupby(['vehicle_id', 'crash_severity'], sort=False).size()
+    severity_counts = severity_counts.sort_values(ascending=False, kind='stable')
+    severities = {}
+    for (vehicle_id, severity), count in severity_counts.items():
+        severities.setdefault(vehicle_id, {})[severity] = int(count)
+    vehicle_summary['crash_severities'] = [severities.get(v, {}) for v in vehicle_summary['vehicle_id']]
     vehicle_summary = vehicle_summary.sort_values('max_score', ascending=False)
 
     vehicle_file = 'crash_involved_vehicles_tagged.csv'
@@ -5,88 +5,22 @@ Filter sudden deceleration vehicles to exclude emergency responders.
 """
 
 import csv
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import numpy as np
+import pandas as pd
 from pyproj import Transformer
+from trip_index import load_trip_cache, read_needed_trips, save_trip_cache
 
 csv.field_size_limit(sys.maxsize)
 
-print("="*80)
-print("PHASE 3: IDENTIFYING CRASH PARTICIPANTS")
-print("="*80)
+transformer_to_nztm = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
 
-# Load vehicles with sudden deceleration or stayed at scene
-print("\nLoading vehicles with involvement indicators...")
-candidates = []
-with open('crash_WITNESSES.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        # Extract vehicles with sudden deceleration or stayed at scene
-        sudden_decel = row['sudden_deceleration'] == 'True'
-        stayed = row['stayed_at_scene'] == 'True'
-
-        if sudden_decel or stayed:
-            candidates.append(row)
-
-print(f"Found {len(candidates)} candidates with involvement indicators")
-print(f"  - Sudden deceleration: {sum(1 for c in candidates if c['sudden_deceleration'] == 'True')}")
-print(f"  - Stayed at scene: {sum(1 for c in candidates if c['stayed_at_scene'] == 'True')}")
-
-# Load trip data to check start/end locations
-print("\nLoading trip origin/destination data...")
-vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
-
-trip_locations = {}
-trips_needed = set([c['trip_id'] for c in candidates])
-
-loaded = 0
-for vfile in vehicle_files:
-    if not trips_needed:
-        break
-
-    with open(vfile, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['TripID'] in trips_needed:
-                # Parse origin and destination coordinates
-                origin = row.get('Origin', '')
-                destination = row.get('Destination', '')
-
-                # Parse RawPath to get first and last coordinates
-                raw_path = row['RawPath'].split(',')
-                if len(raw_path) >= 2:
-                    # First point
-                    first_parts = raw_path[0].strip().split()
-                    if len(first_parts) == 2:
-                        origin_lon, origin_lat = float(first_parts[0]), float(first_parts[1])
-                    else:
-                        origin_lon, origin_lat = None, None
-
-                    # Last point
-                    last_parts = raw_path[-1].strip().split()
-                    if len(last_parts) == 2:
-                        dest_lon, dest_lat = float(last_parts[0]), float(last_parts[1])
-                    else:
-                        dest_lon, dest_lat = None, None
-
-                    trip_locations[row['TripID']] = {
-                        'origin_lat': origin_lat,
-                        'origin_lon': origin_lon,
-                        'dest_lat': dest_lat,
-                        'dest_lon': dest_lon,
-                        'trip_start': row.get('TripStart', ''),
-                        'trip_end': row.get('TripEnd', ''),
-                        'travel_time_min': row.get('TravelTimeMinutes', ''),
-                        'distance_miles': row.get('TravelDistanceMiles', '')
-                    }
-
-                    trips_needed.remove(row['TripID'])
-                    loaded += 1
-
-                    if loaded % 10 == 0:
-                        print(f"  Loaded {loaded} trips...")
-
-print(f"Loaded {len(trip_locations)} trip origin/destination records")
+TRIP_COLUMNS = ['TripID', 'RawPath', 'TripStart', 'TripEnd', 'TravelTimeMinutes', 'TravelDistanceMiles']
+# Origin/destination records from earlier runs, keyed by the vehicle files' mtimes
+TRIP_CACHE_FILE = 'trip_locations_cache.pkl'
 
 # Known hospital/emergency service locations in Auckland
 # These are approximate coordinates for major facilities
@@ -98,138 +32,251 @@ HOSPITALS = {
     'Greenlane Hospital': (-36.8936, 174.7968),
 }
 
-def distance_to_nearest_hospital(lat, lon):
-    """Calculate distance to nearest hospital in meters."""
-    if lat is None or lon is None:
-        return None
-
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
-    x, y = transformer.transform(lon, lat)
-
-    min_dist = float('inf')
-    for name, (h_lat, h_lon) in HOSPITALS.items():
-        h_x, h_y = transformer.transform(h_lon, h_lat)
-        dist = ((x - h_x)**2 + (y - h_y)**2)**0.5
-        if dist < min_dist:
-            min_dist = dist
-
-    return min_dist
-
-# Classify candidates
-print("\nClassifying candidates...")
-emergency_responders = []
-crash_participants = []
-unknown = []
-
-for candidate in candidates:
-    trip_id = candidate['trip_id']
-
-    if trip_id not in trip_locations:
-        unknown.append(candidate)
-        continue
-
-    trip_loc = trip_locations[trip_id]
-
-    # Check if trip starts or ends at hospital
-    origin_hospital_dist = distance_to_nearest_hospital(
-        trip_loc['origin_lat'],
-        trip_loc['origin_lon']
-    )
-    dest_hospital_dist = distance_to_nearest_hospital(
-        trip_loc['dest_lat'],
-        trip_loc['dest_lon']
+# Hospital locations in NZTM, projected once
+HOSPITAL_XY = np.column_stack(transformer_to_nztm.transform(
+    [h_lon for h_lat, h_lon in HOSPITALS.values()],
+    [h_lat for h_lat, h_lon in HOSPITALS.values()]
+))
+
+def scan_vehicle_file(vfile, trips_needed):
+    """Origin/destination record for the first usable row of each needed trip in one vehicle file"""
+    # Only the columns we use, and just the rows for candidate trips
+    trips = read_needed_trips(vfile, TRIP_COLUMNS, trips_needed)
+    if trips is None:
+        return {}
+
+    found = {}
+    for trip_id, raw_path, trip_start, trip_end, travel_time, distance in zip(
+            trips['TripID'], trips['RawPath'], trips['TripStart'], trips['TripEnd'],
+            trips['TravelTimeMinutes'], trips['TravelDistanceMiles']):
+        if trip_id in found:
+            continue
+
+        # Only the first and last points of RawPath are needed
+        head, sep, _ = raw_path.partition(',')
+        if sep:
+            tail = raw_path.rpartition(',')[2]
+
+            # First point
+            first_parts = head.split()
+            if len(first_parts) == 2:
+                origin_lon, origin_lat = float(first_parts[0]), float(first_parts[1])
+            else:
+                origin_lon, origin_lat = None, None
+
+            # Last point
+            last_parts = tail.split()
+            if len(last_parts) == 2:
+                dest_lon, dest_lat = float(last_parts[0]), float(last_parts[1])
+            else:
+                dest_lon, dest_lat = None, None
+
+            found[trip_id] = {
+                'origin_lat': origin_lat,
+                'origin_lon': origin_lon,
+                'dest_lat': dest_lat,
+                'dest_lon': dest_lon,
+                'trip_start': trip_start,
+                'trip_end': trip_end,
+                'travel_time_min': travel_time,
+                'distance_miles': distance
+            }
+    return found
+
+def load_trip_locations(vehicle_files, trips_needed):
+    """Origin/destination records for trips_needed, from the cache or a parallel scan of the vehicle files"""
+    trip_cache = load_trip_cache(TRIP_CACHE_FILE, [(str(vfile), os.stat(vfile).st_mtime) for vfile in vehicle_files])
+    trip_locations = {trip_id: trip_cache['trips'][trip_id] for trip_id in trips_needed if trip_id in trip_cache['trips']}
+    if trip_locations:
+        print(f"  {len(trip_locations)} trips from cache")
+    trips_needed = set(trips_needed) - trip_locations.keys() - trip_cache['missing']
+    if not trips_needed:
+        return trip_locations
+
+    # Files are scanned in parallel but merged in file order, so the first
+    # file holding a trip still wins
+    loaded = 0
+    with ProcessPoolExecutor() as executor:
+        scans = [executor.submit(scan_vehicle_file, vfile, frozenset(trips_needed)) for vfile in vehicle_files]
+        for scan in scans:
+            for trip_id, record in scan.result().items():
+                if trip_id not in trips_needed:
+                    continue
+
+                trip_locations[trip_id] = record
+                trips_needed.remove(trip_id)
+                loaded += 1
+
+                if loaded % 10 == 0:
+                    print(f"  Loaded {loaded} trips...")
+
+            if not trips_needed:
+                # Everything found, skip files not yet started
+                for pending in scans:
+                    pending.cancel()
+                break
+
+    trip_cache['trips'].update(trip_locations)
+    trip_cache['missing'] |= trips_needed
+    save_trip_cache(TRIP_CACHE_FILE, trip_cache)
+    return trip_locations
+
+def distance_to_nearest_hospital(lats, lons):
+    """Distance in meters from each point to its nearest hospital (NaN where lat/lon is missing)."""
+    x, y = transformer_to_nztm.transform(lons, lats)
+    # Running minimum over the few hospitals, so only point-sized buffers are
+    # allocated rather than a points x hospitals distance matrix
+    dists = np.full(len(x), np.inf)
+    dx = np.empty(len(x))
+    dy = np.empty(len(x))
+    for h_x, h_y in HOSPITAL_XY:
+        np.subtract(x, h_x, out=dx)
+        np.subtract(y, h_y, out=dy)
+        dx **= 2
+        dy **= 2
+        dx += dy
+        dx **= 0.5
+        np.minimum(dists, dx, out=dists)
+    dists[np.isnan(lats) | np.isnan(lons)] = np.nan
+    return dists
+
+def reason_part(mask, prefix, values, suffix):
+    """'; ' prefixed reason text where mask holds, empty elsewhere"""
+    # astype(str) keeps an empty selection a string Series rather than float64
+    text = '; ' + prefix + values.map('{:.0f}'.format).astype(str) + suffix
+    return text.where(mask, '')
+
+def dist_column(dist):
+    """Hospital distance as written to the CSV, blank when missing or zero"""
+    return dist.astype(object).where(dist.notna() & (dist != 0), '')
+
+def main():
+    print("="*80)
+    print("PHASE 3: IDENTIFYING CRASH PARTICIPANTS")
+    print("="*80)
+
+    # Load vehicles with sudden deceleration or stayed at scene
+    print("\nLoading vehicles with involvement indicators...")
+    witnesses = pd.read_csv('crash_WITNESSES.csv', dtype=str, keep_default_na=False)
+
+    # Extract vehicles with sudden deceleration or stayed at scene
+    sudden_decel = witnesses['sudden_deceleration'] == 'True'
+    stayed = witnesses['stayed_at_scene'] == 'True'
+    candidates = witnesses[sudden_decel | stayed].reset_index(drop=True)
+
+    print(f"Found {len(candidates)} candidates with involvement indicators")
+    print(f"  - Sudden deceleration: {(candidates['sudden_deceleration'] == 'True').sum()}")
+    print(f"  - Stayed at scene: {(candidates['stayed_at_scene'] == 'True').sum()}")
+
+    # Load trip data to check start/end locations
+    print("\nLoading trip origin/destination data...")
+    vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
+    trip_locations = load_trip_locations(vehicle_files, set(candidates['trip_id']))
+
+    print(f"Loaded {len(trip_locations)} trip origin/destination records")
+
+    # Classify candidates
+    print("\nClassifying candidates...")
+
+    # Line up each candidate with its trip's first/last point (NaN when unknown)
+    trip_loc_df = pd.DataFrame(
+        list(trip_locations.values()), index=list(trip_locations.keys()),
+        columns=['origin_lat', 'origin_lon', 'dest_lat', 'dest_lon']
+    ).astype(np.float64)
+    has_trip = candidates['trip_id'].isin(trip_locations).to_numpy()
+    unknown = candidates[~has_trip]
+    classified = candidates[has_trip].reset_index(drop=True)
+    locs = trip_loc_df.reindex(classified['trip_id'])
+
+    # Origin and destination distances for all candidates in one batch
+    hospital_dists = distance_to_nearest_hospital(
+        np.concatenate([locs['origin_lat'].to_numpy(), locs['dest_lat'].to_numpy()]),
+        np.concatenate([locs['origin_lon'].to_numpy(), locs['dest_lon'].to_numpy()])
     )
-
-    # Classification logic
-    is_emergency = False
-    reason = []
+    origin_dist = pd.Series(hospital_dists[:len(classified)])
+    dest_dist = pd.Series(hospital_dists[len(classified):])
+    max_speed = pd.to_numeric(classified['trip_speed_max'], errors='coerce')
 
     # Starts at hospital (ambulance dispatched)
-    if origin_hospital_dist is not None and origin_hospital_dist < 500:
-        is_emergency = True
-        reason.append(f"Origin near hospital ({origin_hospital_dist:.0f}m)")
-
+    origin_near = origin_dist < 500
     # Ends at hospital (ambulance returning with patient)
-    if dest_hospital_dist is not None and dest_hospital_dist < 500:
-        is_emergency = True
-        reason.append(f"Destination near hospital ({dest_hospital_dist:.0f}m)")
-
-    # Stayed at scene AND high speed approach (typical ambulance behavior)
-    if candidate['stayed_at_scene'] == 'True':
-        try:
-            max_speed = float(candidate['trip_speed_max'])
-            if max_speed > 80:  # >80 mph suggests emergency vehicle
-                is_emergency = True
-                reason.append(f"High speed approach ({max_speed:.0f} mph)")
-        except:
-            pass
+    dest_near = dest_dist < 500
+    # Stayed at scene AND high speed approach (typical ambulance behavior), >80 mph suggests emergency vehicle
+    high_speed = (classified['stayed_at_scene'] == 'True') & (max_speed > 80)
+    is_emergency = origin_near | dest_near | high_speed
+
+    reason = (reason_part(origin_near, 'Origin near hospital (', origin_dist, 'm)')
+              + reason_part(dest_near, 'Destination near hospital (', dest_dist, 'm)')
+              + reason_part(high_speed, 'High speed approach (', max_speed, ' mph)')).str[2:]
 
     # Add classification result
-    result = {**candidate}
-    result['origin_hospital_dist'] = origin_hospital_dist if origin_hospital_dist else ''
-    result['dest_hospital_dist'] = dest_hospital_dist if dest_hospital_dist else ''
-    result['classification'] = 'EMERGENCY_RESPONDER' if is_emergency else 'CRASH_PARTICIPANT'
-    result['classification_reason'] = '; '.join(reason) if reason else 'Sudden deceleration at crash'
-
-    if is_emergency:
-        emergency_responders.append(result)
-    else:
-        crash_participants.append(result)
-
-print("\n" + "="*80)
-print("CLASSIFICATION RESULTS")
-print("="*80)
-print(f"\nEmergency Responders: {len(emergency_responders)}")
-print(f"Crash Participants: {len(crash_participants)}")
-print(f"Unknown (missing trip data): {len(unknown)}")
-
-# Show sample emergency responders
-if emergency_responders:
-    print("\n" + "-"*80)
-    print("EMERGENCY RESPONDERS (Sample)")
-    print("-"*80)
-    for i, er in enumerate(emergency_responders[:5], 1):
-        print(f"\n{i}. Trip: {er['trip_id'][:20]}...")
-        print(f"   Vehicle: {er['vehicle_type']}")
-        print(f"   Crash: {er['nzta_severity']} at {er['nzta_location']}")
-        print(f"   Reason: {er['classification_reason']}")
-
-# Show sample crash participants
-if crash_participants:
-    print("\n" + "-"*80)
-    print("CRASH PARTICIPANTS (Sample)")
-    print("-"*80)
-    for i, cp in enumerate(crash_participants[:5], 1):
-        print(f"\n{i}. Trip: {cp['trip_id'][:20]}...")
-        print(f"   Vehicle: {cp['vehicle_type']}")
-        print(f"   Crash: {cp['nzta_severity']} at {cp['nzta_location']}")
-        print(f"   Distance: {cp['distance_to_crash']}m")
-        print(f"   Time diff: {cp['time_diff_minutes']} min")
-        print(f"   Speed at crash: {cp['speed_at_point']} mph")
-        print(f"   Sudden decel: {cp['sudden_deceleration']}")
-        print(f"   Stayed at scene: {cp['stayed_at_scene']}")
-
-# Export results
-if emergency_responders:
-    with open('emergency_responders.csv', 'w', newline='') as f:
-        fieldnames = list(emergency_responders[0].keys())
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(emergency_responders)
-    print(f"\n✓ Exported: emergency_responders.csv ({len(emergency_responders)} records)")
-
-if crash_participants:
-    with open('crash_participants.csv', 'w', newline='') as f:
-        fieldnames = list(crash_participants[0].keys())
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(crash_participants)
-    print(f"✓ Exported: crash_participants.csv ({len(crash_participants)} records)")
-
-print("\n" + "="*80)
-print("ANALYSIS COMPLETE")
-print("="*80)
-print("\nNext steps:")
-print("  1. Review crash_participants.csv for likely crash-involved vehicles")
-print("  2. Proceed to Phase 4: Pre-crash behavior analysis")
-print("  3. Update showcase map to highlight crash participants vs witnesses")
+    classified = classified.assign(
+        origin_hospital_dist=dist_column(origin_dist),
+        dest_hospital_dist=dist_column(dest_dist),
+        classification=np.where(is_emergency, 'EMERGENCY_RESPONDER', 'CRASH_PARTICIPANT'),
+        classification_reason=reason.where(reason != '', 'Sudden deceleration at crash')
+    )
+
+    emergency_responders = classified[is_emergency].to_dict('records')
+    crash_participants = classified[~is_emergency].to_dict('records')
+
+    print("\n" + "="*80)
+    print("CLASSIFICATION RESULTS")
+    print("="*80)
+    print(f"\nEmergency Responders: {len(emergency_responders)}")
+    print(f"Crash Participants: {len(crash_participants)}")
+    print(f"Unknown (missing trip data): {len(unknown)}")
+
+    # Show sample emergency responders
+    if emergency_responders:
+        print("\n" + "-"*80)
+        print("EMERGENCY RESPONDERS (Sample)")
+        print("-"*80)
+        for i, er in enumerate(emergency_responders[:5], 1):
+            print(f"\n{i}. Trip: {er['trip_id'][:20]}...")
+            print(f"   Vehicle: {er['vehicle_type']}")
+            print(f"   Crash: {er['nzta_severity']} at {er['nzta_location']}")
+            print(f"   Reason: {er['classification_reason']}")
+
+    # Show sample crash participants
+    if crash_participants:
+        print("\n" + "-"*80)
+        print("CRASH PARTICIPANTS (Sample)")
+        print("-"*80)
+        for i, cp in enumerate(crash_participants[:5], 1):
+            print(f"\n{i}. Trip: {cp['trip_id'][:20]}...")
+            print(f"   Vehicle: {cp['vehicle_type']}")
+            print(f"   Crash: {cp['nzta_severity']} at {cp['nzta_location']}")
+            print(f"   Distance: {cp['distance_to_crash']}m")
+            print(f"   Time diff: {cp['time_diff_minutes']} min")
+            print(f"   Speed at crash: {cp['speed_at_point']} mph")
+            print(f"   Sudden decel: {cp['sudden_deceleration']}")
+            print(f"   Stayed at scene: {cp['stayed_at_scene']}")
+
+    # Export results
+    if emergency_responders:
+        with open('emergency_responders.csv', 'w', newline='') as f:
+            fieldnames = list(emergency_responders[0].keys())
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(emergency_responders)
+        print(f"\n✓ Exported: emergency_responders.csv ({len(emergency_responders)} records)")
+
+    if crash_participants:
+        with open('crash_participants.csv', 'w', newline='') as f:
+            fieldnames = list(crash_participants[0].keys())
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(crash_participants)
+        print(f"✓ Exported: crash_participants.csv ({len(crash_participants)} records)")
+
+    print("\n" + "="*80)
+    print("ANALYSIS COMPLETE")
+    print("="*80)
+    print("\nNext steps:")
+    print("  1. Review crash_participants.csv for likely crash-involved vehicles")
+    print("  2. Proceed to Phase 4: Pre-crash behavior analysis")
+    print("  3. Update showcase map to highlight crash participants vs witnesses")
+
+if __name__ == "__main__":
+    main()
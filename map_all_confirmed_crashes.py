@@ -4,108 +4,169 @@ Map all 188 confirmed crash-involved/witness vehicles on a single map.
 Light basemap with crash markers and vehicle paths.
 """
 
-import csv
-import sys
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from collections import defaultdict
-
-csv.field_size_limit(sys.maxsize)
-
-print("Loading confirmed matches...")
-
-# Load all confirmed matches
-matches = []
-with open('confirmed_crash_vehicles_5min.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    matches = list(reader)
-
-print(f"Loaded {len(matches)} matches")
-
-# Group by crash
-crashes_dict = {}
-for match in matches:
-    crash_id = match['nzta_crash_id']
-    if crash_id not in crashes_dict:
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from paths import parse_path
+from trip_index import load_trip_cache, read_needed_trips, save_trip_cache
+
+transformer_to_wgs = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
+
+# Parsed paths from earlier runs, keyed by the vehicle files' mtimes
+TRIP_CACHE_FILE = 'trip_paths_cache.pkl'
+
+def scan_vehicle_file(vfile, trips_needed):
+    """(row, coords) for the first row of each needed trip in one vehicle file"""
+    # Only the columns we use, and just the rows for confirmed trips
+    trips = read_needed_trips(vfile, ['TripID', 'RawPath'], trips_needed)
+    if trips is None:
+        return {}
+
+    found = {}
+    for row, trip_id, raw_path in zip(trips.index, trips['TripID'], trips['RawPath']):
+        if trip_id not in found:
+            found[trip_id] = (row, parse_path(raw_path))
+    return found
+
+def load_trip_paths(vehicle_files, trips_needed):
+    """Paths for trips_needed in vehicle file order, from the cache or a parallel scan of the vehicle files"""
+    trip_cache = load_trip_cache(TRIP_CACHE_FILE, [(str(vfile), os.stat(vfile).st_mtime) for vfile in vehicle_files])
+    # trip_id -> ((file number, row), coords) so cached and scanned paths keep file order
+    found = {trip_id: trip_cache['trips'][trip_id] for trip_id in trips_needed if trip_id in trip_cache['trips']}
+    if found:
+        print(f"  {len(found)} trip paths from cache")
+    trips_needed = set(trips_needed) - found.keys() - trip_cache['missing']
+
+    if trips_needed:
+        # Files are scanned in parallel but merged in file order, so the first
+        # file holding a trip still wins
+        loaded = 0
+        with ProcessPoolExecutor() as executor:
+            scans = [executor.submit(scan_vehicle_file, vfile, frozenset(trips_needed)) for vfile in vehicle_files]
+            for file_num, scan in enumerate(scans):
+                for trip_id, (row, coords) in scan.result().items():
+                    if trip_id not in trips_needed:
+                        continue
+
+                    found[trip_id] = ((file_num, row), coords)
+                    trips_needed.remove(trip_id)
+                    loaded += 1
+
+                    if loaded % 20 == 0:
+                        print(f"  Loaded {loaded}/{len(found)} trip paths...")
+
+                if not trips_needed:
+                    # Everything found, skip files not yet started
+                    for pending in scans:
+                        pending.cancel()
+                    break
+
+        trip_cache['trips'].update(found)
+        trip_cache['missing'] |= trips_needed
+        save_trip_cache(TRIP_CACHE_FILE, trip_cache)
+
+    return {trip_id: coords for trip_id, (_, coords) in sorted(found.items(), key=lambda item: item[1][0])}
+
+def main():
+    print("Loading confirmed matches...")
+
+    # Load all confirmed matches (values kept as the exact strings written)
+    matches = pd.read_csv('confirmed_crash_vehicles_5min.csv', dtype=str, keep_default_na=False)
+
+    print(f"Loaded {len(matches)} matches")
+
+    # Group by crash, in order of first appearance
+    by_crash = matches.groupby('nzta_crash_id', sort=False)
+    first = by_crash[['nzta_severity', 'nzta_location', 'nzta_road', 'crash_datetime', 'crash_x', 'crash_y']].first()
+    vehicle_records = matches[['trip_id', 'vehicle_type', 'distance_to_crash', 'time_diff_minutes',
+                               'combined_score', 'crash_x', 'crash_y']].to_dict('records')
+    crash_rows = by_crash.indices
+
+    crashes_dict = {}
+    for crash_id, severity, location, road, crash_datetime in zip(
+            first.index, first['nzta_severity'], first['nzta_location'], first['nzta_road'], first['crash_datetime']):
         crashes_dict[crash_id] = {
             'crash_id': crash_id,
             'lat': None,
             'lon': None,
-            'severity': match['nzta_severity'],
-            'location': match['nzta_location'],
-            'road': match['nzta_road'],
-            'datetime': match['crash_datetime'],
-            'vehicles': []
+            'severity': severity,
+            'location': location,
+            'road': road,
+            'datetime': crash_datetime,
+            'vehicles': [vehicle_records[i] for i in crash_rows[crash_id]]
         }
-    crashes_dict[crash_id]['vehicles'].append(match)
 
-# Get crash coordinates (need to convert NZTM to WGS84)
-from pyproj import Transformer
-transformer = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
-
-for crash_id, crash_data in crashes_dict.items():
-    # Use first match to get crash coords
-    match = crash_data['vehicles'][0]
-    crash_lon, crash_lat = transformer.transform(
-        float(match['crash_x']),
-        float(match['crash_y'])
+    # Get crash coordinates (need to convert NZTM to WGS84)
+    # Use first match of each crash for its coords, projected in one call
+    crash_lons, crash_lats = transformer_to_wgs.transform(
+        first['crash_x'].astype(np.float64).to_numpy(),
+        first['crash_y'].astype(np.float64).to_numpy()
+    )
+    for crash_data, crash_lat, crash_lon in zip(crashes_dict.values(), crash_lats.tolist(), crash_lons.tolist()):
+        crash_data['lat'] = crash_lat
+        crash_data['lon'] = crash_lon
+
+    print(f"Unique crashes: {len(crashes_dict)}")
+
+    # Load trip data for paths
+    print("\nLoading trip paths...")
+    vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
+    trip_paths = load_trip_paths(vehicle_files, set(matches['trip_id']))
+    print(f"Loaded {len(trip_paths)} trip paths")
+
+    # Create HTML map
+    print("\nGenerating map...")
+
+    # Calculate center point
+    all_lats = [c['lat'] for c in crashes_dict.values()]
+    all_lons = [c['lon'] for c in crashes_dict.values()]
+    center_lat = sum(all_lats) / len(all_lats)
+    center_lon = sum(all_lons) / len(all_lons)
+
+    # Color by severity
+    severity_colors = {
+        'Fatal Crash': '#8B0000',
+        'Serious Crash': '#FF4500',
+        'Minor Crash': '#FFA500',
+        'Non-Injury Crash': '#FFD700'
+    }
+
+    # Crash markers and trip paths are embedded as JSON
+    crashes_list = []
+    for crash_id, crash in crashes_dict.items():
+        crashes_list.append({
+            'lat': crash['lat'],
+            'lon': crash['lon'],
+            'id': crash_id,
+            'severity': crash['severity'],
+            'location': crash['location'],
+            'road': crash['road'],
+            'datetime': crash['datetime'],
+            'color': severity_colors.get(crash['severity'], '#999'),
+            'num_vehicles': len(crash['vehicles']),
+            'vehicles': [{
+                'trip_id': v['trip_id'],
+                'vehicle_type': v['vehicle_type'],
+                'distance': v['distance_to_crash'],
+                'time_diff': v['time_diff_minutes'],
+                'score': v['combined_score']
+            } for v in crash['vehicles']]
+        })
+    crashes_json = json.dumps(crashes_list, separators=(',', ':'))
+
+    trip_paths_json = json.dumps(
+        {trip_id: coords.tolist() for trip_id, coords in trip_paths.items() if len(coords) > 0},
+        separators=(',', ':')
     )
-    crash_data['lat'] = crash_lat
-    crash_data['lon'] = crash_lon
-
-print(f"Unique crashes: {len(crashes_dict)}")
-
-# Load trip data for paths
-print("\nLoading trip paths...")
-vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
-
-trip_paths = {}
-trips_needed = set([m['trip_id'] for m in matches])
-
-loaded = 0
-for vfile in vehicle_files:
-    if not trips_needed:
-        break
-
-    with open(vfile, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['TripID'] in trips_needed:
-                # Parse path
-                raw_path = row['RawPath'].split(',')
-                coords = []
-                for point_str in raw_path:
-                    parts = point_str.strip().split()
-                    if len(parts) == 2:
-                        lon, lat = float(parts[0]), float(parts[1])
-                        coords.append([lat, lon])
-
-                trip_paths[row['TripID']] = coords
-                trips_needed.remove(row['TripID'])
-                loaded += 1
-
-                if loaded % 20 == 0:
-                    print(f"  Loaded {loaded}/{len(trip_paths)} trip paths...")
-
-print(f"Loaded {len(trip_paths)} trip paths")
-
-# Create HTML map
-print("\nGenerating map...")
-
-# Calculate center point
-all_lats = [c['lat'] for c in crashes_dict.values()]
-all_lons = [c['lon'] for c in crashes_dict.values()]
-center_lat = sum(all_lats) / len(all_lats)
-center_lon = sum(all_lons) / len(all_lons)
-
-# Color by severity
-severity_colors = {
-    'Fatal Crash': '#8B0000',
-    'Serious Crash': '#FF4500',
-    'Minor Crash': '#FFA500',
-    'Non-Injury Crash': '#FFD700'
-}
-
-html = f"""<!DOCTYPE html>
+
+    # The page is written as template pieces around the two JSON blobs rather
+    # than formatted into one string first
+    html_head = f"""<!DOCTYPE html>
 <html>
 <head>
     <title>Confirmed Crash-Vehicle Matches - Auckland 2025</title>
@@ -154,38 +215,8 @@ html = f"""<!DOCTYPE html>
         }}).addTo(map);
 
         // Crash data
-        var crashes = [
-"""
-
-for crash_id, crash in crashes_dict.items():
-    num_vehicles = len(crash['vehicles'])
-    color = severity_colors.get(crash['severity'], '#999')
-
-    vehicles_info = []
-    for v in crash['vehicles']:
-        vehicles_info.append({
-            'trip_id': v['trip_id'],
-            'vehicle_type': v['vehicle_type'],
-            'distance': v['distance_to_crash'],
-            'time_diff': v['time_diff_minutes'],
-            'score': v['combined_score']
-        })
-
-    html += f"""            {{
-                lat: {crash['lat']},
-                lon: {crash['lon']},
-                id: '{crash_id}',
-                severity: '{crash['severity']}',
-                location: '{crash['location']}',
-                road: '{crash['road']}',
-                datetime: '{crash['datetime']}',
-                color: '{color}',
-                num_vehicles: {num_vehicles},
-                vehicles: {vehicles_info}
-            }},
-"""
-
-html += f"""        ];
+        var crashes = """
+    html_middle = f""";
 
         // Add crash markers
         crashes.forEach(function(crash) {{
@@ -214,15 +245,8 @@ html += f"""        ];
         }});
 
         // Add trip paths
-        var tripPaths = {{
-"""
-
-for trip_id, coords in trip_paths.items():
-    if len(coords) > 0:
-        coords_js = str(coords).replace("'", '"')
-        html += f"""            '{trip_id}': {coords_js},\n"""
-
-html += f"""        }};
+        var tripPaths = """
+    html_tail = f""";
 
         // Draw paths with low opacity
         Object.entries(tripPaths).forEach(([tripId, coords]) => {{
@@ -267,15 +291,19 @@ html += f"""        }};
 </body>
 </html>"""
 
-output_file = 'all_confirmed_crashes_map.html'
-with open(output_file, 'w') as f:
-    f.write(html)
-
-print(f"\n✓ Map created: {output_file}")
-print(f"\nMap features:")
-print(f"  • Light CartoDB basemap with street details")
-print(f"  • {len(crashes_dict)} crash markers (color-coded by severity)")
-print(f"  • {len(trip_paths)} vehicle path traces (semi-transparent blue)")
-print(f"  • Marker size shows number of vehicles")
-print(f"  • Click any crash for vehicle details")
-print(f"\nOpen in browser to explore!")
+    output_file = 'all_confirmed_crashes_map.html'
+    with open(output_file, 'w') as f:
+        for part in (html_head, crashes_json, html_middle, trip_paths_json, html_tail):
+            f.write(part)
+
+    print(f"\n✓ Map created: {output_file}")
+    print(f"\nMap features:")
+    print(f"  • Light CartoDB basemap with street details")
+    print(f"  • {len(crashes_dict)} crash markers (color-coded by severity)")
+    print(f"  • {len(trip_paths)} vehicle path traces (semi-transparent blue)")
+    print(f"  • Marker size shows number of vehicles")
+    print(f"  • Click any crash for vehicle details")
+    print(f"\nOpen in browser to explore!")
+
+if __name__ == "__main__":
+    main()
@@ -3,109 +3,192 @@
 Interactive map: Click crash to highlight its vehicles and dim others.
 """
 
-import csv
-import sys
+import base64
+import json
+import os
+import pickle
 from pathlib import Path
-from collections import defaultdict
-
-csv.field_size_limit(sys.maxsize)
-
-print("Loading confirmed matches...")
-
-matches = []
-with open('confirmed_crash_vehicles_5min.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    matches = list(reader)
-
-print(f"Loaded {len(matches)} matches")
-
-# Group by crash
-crashes_dict = {}
-crash_to_trips = defaultdict(list)
-
-for match in matches:
-    crash_id = match['nzta_crash_id']
-    trip_id = match['trip_id']
-
-    crash_to_trips[crash_id].append(trip_id)
-
-    if crash_id not in crashes_dict:
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from paths import parse_path
+from trip_index import load_trip_index, read_trip_rows
+
+# Paths are drawn simplified to about 1m (in degrees) and rounded to 5 decimals
+PATH_TOLERANCE = 1e-5
+PATH_DECIMALS = 5
+
+def simplify_path(coords):
+    """Douglas-Peucker simplified copy of a lat/lon path, rounded for the page"""
+    if len(coords) > 2:
+        line = shapely.simplify(shapely.LineString(coords), PATH_TOLERANCE, preserve_topology=False)
+        coords = shapely.get_coordinates(line)
+    return np.round(coords, PATH_DECIMALS).tolist()
+
+MATCH_COLUMNS = ['nzta_crash_id', 'trip_id', 'nzta_severity', 'nzta_location', 'nzta_road', 'crash_datetime',
+                 'crash_x', 'crash_y', 'vehicle_type', 'distance_to_crash', 'time_diff_minutes', 'combined_score']
+
+# Grouped crashes and parsed trip paths from the last run, keyed by the input files' mtimes
+MAP_DATA_CACHE_FILE = 'interactive_map_cache.pkl'
+
+def build_map_data(vehicle_files):
+    """Group the confirmed matches by crash and load the trip paths they need"""
+    print("Loading confirmed matches...")
+
+    # Only the columns the map uses, values kept as the exact strings written
+    matches = pd.read_csv('confirmed_crash_vehicles_5min.csv', usecols=MATCH_COLUMNS, dtype=str, keep_default_na=False)
+
+    print(f"Loaded {len(matches)} matches")
+
+    # Group by crash, in order of first appearance
+    by_crash = matches.groupby('nzta_crash_id', sort=False)
+    first = by_crash[['nzta_severity', 'nzta_location', 'nzta_road', 'crash_datetime', 'crash_x', 'crash_y']].first()
+    vehicle_records = matches[['trip_id', 'vehicle_type', 'distance_to_crash', 'time_diff_minutes',
+                               'combined_score']].to_dict('records')
+    crash_rows = by_crash.indices
+
+    crashes_dict = {}
+    crash_to_trips = {}
+    for crash_id, severity, location, road, crash_datetime in zip(
+            first.index, first['nzta_severity'], first['nzta_location'], first['nzta_road'], first['crash_datetime']):
+        vehicles = [vehicle_records[i] for i in crash_rows[crash_id]]
+        crash_to_trips[crash_id] = [v['trip_id'] for v in vehicles]
         crashes_dict[crash_id] = {
             'crash_id': crash_id,
             'lat': None,
             'lon': None,
-            'severity': match['nzta_severity'],
-            'location': match['nzta_location'],
-            'road': match['nzta_road'],
-            'datetime': match['crash_datetime'],
-            'vehicles': []
+            'severity': severity,
+            'location': location,
+            'road': road,
+            'datetime': crash_datetime,
+            'vehicles': vehicles
         }
-    crashes_dict[crash_id]['vehicles'].append(match)
 
-# Get crash coordinates
-from pyproj import Transformer
-transformer = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
+    # Get crash coordinates
+    transformer = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
 
-for crash_id, crash_data in crashes_dict.items():
-    match = crash_data['vehicles'][0]
-    crash_lon, crash_lat = transformer.transform(
-        float(match['crash_x']),
-        float(match['crash_y'])
+    # First match of each crash gives its coords, projected in one call
+    crash_lons, crash_lats = transformer.transform(
+        first['crash_x'].astype(np.float64).to_numpy(),
+        first['crash_y'].astype(np.float64).to_numpy()
     )
-    crash_data['lat'] = crash_lat
-    crash_data['lon'] = crash_lon
-
-print(f"Unique crashes: {len(crashes_dict)}")
-
-# Load trip paths
-print("\nLoading trip paths...")
-vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
-
-trip_paths = {}
-trips_needed = set([m['trip_id'] for m in matches])
-
-loaded = 0
-for vfile in vehicle_files:
-    if not trips_needed:
-        break
-
-    with open(vfile, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['TripID'] in trips_needed:
-                raw_path = row['RawPath'].split(',')
-                coords = []
-                for point_str in raw_path:
-                    parts = point_str.strip().split()
-                    if len(parts) == 2:
-                        lon, lat = float(parts[0]), float(parts[1])
-                        coords.append([lat, lon])
-
-                trip_paths[row['TripID']] = coords
-                trips_needed.remove(row['TripID'])
-                loaded += 1
-
-                if loaded % 20 == 0:
-                    print(f"  Loaded {loaded} trip paths...")
-
-print(f"Loaded {len(trip_paths)} trip paths")
-
-# Create HTML map
-print("\nGenerating interactive map...")
-
-all_lats = [c['lat'] for c in crashes_dict.values()]
-all_lons = [c['lon'] for c in crashes_dict.values()]
-center_lat = sum(all_lats) / len(all_lats)
-center_lon = sum(all_lons) / len(all_lons)
-
-severity_colors = {
-    'Fatal Crash': '#8B0000',
-    'Serious Crash': '#FF4500',
-    'Minor Crash': '#FFA500',
-    'Non-Injury Crash': '#FFD700'
-}
-
-html = f"""<!DOCTYPE html>
+
+    for crash_data, crash_lat, crash_lon in zip(crashes_dict.values(), crash_lats.tolist(), crash_lons.tolist()):
+        crash_data['lat'] = crash_lat
+        crash_data['lon'] = crash_lon
+
+    print(f"Unique crashes: {len(crashes_dict)}")
+
+    # Load trip paths
+    print("\nLoading trip paths...")
+
+    trip_paths = {}
+    trips_needed = frozenset(matches['trip_id'])
+
+    # Seek straight to each needed trip, keeping the order of a sequential scan
+    trip_index = load_trip_index(vehicle_files)
+    trip_rows = read_trip_rows(trip_index, trips_needed)
+    file_order = {str(vfile): i for i, vfile in enumerate(vehicle_files)}
+    scan_order = sorted(trip_rows, key=lambda t: (file_order[trip_index[t][0]], trip_index[t][1]))
+
+    loaded = 0
+    for trip_id in scan_order:
+        trip_paths[trip_id] = parse_path(trip_rows[trip_id]['RawPath']).tolist()
+        loaded += 1
+
+        if loaded % 20 == 0:
+            print(f"  Loaded {loaded} trip paths...")
+
+    print(f"Loaded {len(trip_paths)} trip paths")
+
+    return {
+        'num_matches': len(matches),
+        'crashes_dict': crashes_dict,
+        'crash_to_trips': crash_to_trips,
+        'trip_paths': trip_paths
+    }
+
+def load_map_data(vehicle_files):
+    """Map data from the cache, rebuilt when the matches or any vehicle file has changed"""
+    mtimes = {str(path): os.stat(path).st_mtime
+              for path in ['confirmed_crash_vehicles_5min.csv'] + vehicle_files}
+    try:
+        with open(MAP_DATA_CACHE_FILE, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['mtimes'] == mtimes:
+            print(f"Loaded {cached['num_matches']} matches, {len(cached['crashes_dict'])} crashes "
+                  f"and {len(cached['trip_paths'])} trip paths from cache")
+            return cached
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    map_data = build_map_data(vehicle_files)
+    with open(MAP_DATA_CACHE_FILE, 'wb') as f:
+        pickle.dump({'mtimes': mtimes, **map_data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return map_data
+
+def main():
+    vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
+    map_data = load_map_data(vehicle_files)
+    crashes_dict = map_data['crashes_dict']
+    crash_to_trips = map_data['crash_to_trips']
+    trip_paths = map_data['trip_paths']
+
+    # Create HTML map
+    print("\nGenerating interactive map...")
+
+    severity_colors = {
+        'Fatal Crash': '#8B0000',
+        'Serious Crash': '#FF4500',
+        'Minor Crash': '#FFA500',
+        'Non-Injury Crash': '#FFD700'
+    }
+
+    # Crash markers and trip paths are embedded as JSON, the map center is
+    # summed up in the same pass over the crashes
+    crashes_list = []
+    lat_sum = lon_sum = 0
+    for crash_id, crash in crashes_dict.items():
+        lat_sum += crash['lat']
+        lon_sum += crash['lon']
+        crashes_list.append({
+            'lat': crash['lat'],
+            'lon': crash['lon'],
+            'id': crash_id,
+            'severity': crash['severity'],
+            'location': crash['location'],
+            'road': crash['road'],
+            'datetime': crash['datetime'],
+            'color': severity_colors.get(crash['severity'], '#999'),
+            'num_vehicles': len(crash['vehicles']),
+            'trip_ids': crash_to_trips[crash_id],
+            'vehicles': [{
+                'trip_id': v['trip_id'],
+                'vehicle_type': v['vehicle_type'],
+                'distance': v['distance_to_crash'],
+                'time_diff': v['time_diff_minutes'],
+                'score': v['combined_score']
+            } for v in crash['vehicles']]
+        })
+    center_lat = lat_sum / len(crashes_list)
+    center_lon = lon_sum / len(crashes_list)
+    crashes_json = json.dumps(crashes_list, separators=(',', ':'))
+
+    # Trip paths as indices into a pool of the distinct lat/lon pairs, so points
+    # shared by several trips are written once. Single point paths are left out
+    # as they were never drawn
+    coord_pool = {}
+    trip_path_indices = {}
+    for trip_id, coords in trip_paths.items():
+        if len(coords) > 1:
+            trip_path_indices[trip_id] = [coord_pool.setdefault((lat, lon), len(coord_pool))
+                                          for lat, lon in simplify_path(coords)]
+    # The pool goes in as little-endian float32 bytes, base64 encoded
+    coord_pool_b64 = base64.b64encode(np.array(list(coord_pool), dtype='<f4').tobytes()).decode('ascii')
+    trip_paths_json = json.dumps(trip_path_indices, separators=(',', ':'))
+
+    html_head = f"""<!DOCTYPE html>
 <html>
 <head>
     <title>Interactive Crash-Vehicle Matches - Auckland 2025</title>
@@ -113,6 +196,9 @@ html = f"""<!DOCTYPE html>
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
     <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+    <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.css" />
+    <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.Default.css" />
+    <script src="https://unpkg.com/leaflet.markercluster@1.5.3/dist/leaflet.markercluster.js"></script>
     <style>
         body {{ margin: 0; padding: 0; }}
         #map {{ height: 100vh; width: 100vw; }}
@@ -162,7 +248,10 @@ html = f"""<!DOCTYPE html>
     <div id="map"></div>
     <div id="clear-selection" onclick="clearSelection()">✕ Clear Selection</div>
     <script>
-        var map = L.map('map').setView([{center_lat}, {center_lon}], 11);
+        var map = L.map('map', {{preferCanvas: true}}).setView([{center_lat}, {center_lon}], 11);
+
+        // Markers are drawn on one canvas rather than as SVG elements
+        var canvasRenderer = L.canvas({{padding: 0.5}});
 
         L.tileLayer('https://{{s}}.basemaps.cartocdn.com/light_all/{{z}}/{{x}}/{{y}}{{r}}.png', {{
             attribution: '© OpenStreetMap contributors © CARTO',
@@ -173,45 +262,26 @@ html = f"""<!DOCTYPE html>
         var crashMarkers = {{}};
         var pathLayers = {{}};
 
-        // Crash data
-        var crashes = [
-"""
+        // Styles shared by every marker and path, built once rather than on each click
+        const CRASH_DIM_STYLE = {{fillColor: '#ccc', opacity: 0.3, fillOpacity: 0.3, weight: 1, color: '#999'}};
+        const PATH_STYLE = {{color: '#0066cc', weight: 2, opacity: 0.2}};
+        const PATH_HIGHLIGHT_STYLE = {{color: '#ff00ff', weight: 3, opacity: 0.9}};
+        const PATH_DIM_STYLE = {{color: '#ccc', weight: 1, opacity: 0.1}};
 
-for crash_id, crash in crashes_dict.items():
-    num_vehicles = len(crash['vehicles'])
-    color = severity_colors.get(crash['severity'], '#999')
-    trip_ids = crash_to_trips[crash_id]
-
-    vehicles_info = []
-    for v in crash['vehicles']:
-        vehicles_info.append({
-            'trip_id': v['trip_id'],
-            'vehicle_type': v['vehicle_type'],
-            'distance': v['distance_to_crash'],
-            'time_diff': v['time_diff_minutes'],
-            'score': v['combined_score']
-        })
+        // Crash data
+        var crashes = """
 
-    html += f"""            {{
-                lat: {crash['lat']},
-                lon: {crash['lon']},
-                id: '{crash_id}',
-                severity: '{crash['severity']}',
-                location: '{crash['location']}',
-                road: '{crash['road']}',
-                datetime: '{crash['datetime']}',
-                color: '{color}',
-                num_vehicles: {num_vehicles},
-                trip_ids: {trip_ids},
-                vehicles: {vehicles_info}
-            }},
-"""
+    html_middle = f""";
 
-html += f"""        ];
+        // Large crash sets are clustered; clustering stops by the zoom highlightCrash uses
+        var crashLayer = crashes.length > 500
+            ? L.markerClusterGroup({{chunkedLoading: true, disableClusteringAtZoom: 13}})
+            : L.layerGroup();
 
         // Create crash markers
         crashes.forEach(function(crash) {{
             var marker = L.circleMarker([crash.lat, crash.lon], {{
+                renderer: canvasRenderer,
                 radius: 6 + Math.min(crash.num_vehicles * 2, 10),
                 fillColor: crash.color,
                 color: '#fff',
@@ -219,7 +289,8 @@ html += f"""        ];
                 opacity: 1,
                 fillOpacity: 0.8,
                 className: 'crash-marker'
-            }}).addTo(map);
+            }});
+            crashLayer.addLayer(marker);
 
             var vehicleList = crash.vehicles.map(v =>
                 `<li>${{v.vehicle_type}}: ${{v.distance}}m away, ${{v.time_diff}}min diff (score: ${{v.score}})</li>`
@@ -241,6 +312,9 @@ html += f"""        ];
                 highlightCrash(crash.id);
             }});
 
+            // Set of the crash's trips for constant time lookups when highlighting
+            crash.tripSet = new Set(crash.trip_ids);
+
             crashMarkers[crash.id] = {{
                 marker: marker,
                 originalStyle: {{
@@ -248,40 +322,59 @@ html += f"""        ];
                     opacity: 1,
                     fillOpacity: 0.8,
                     weight: 2
+                }},
+                highlightStyle: {{
+                    fillColor: crash.color,
+                    opacity: 1,
+                    fillOpacity: 1,
+                    weight: 4,
+                    color: '#fff'
                 }}
             }};
         }});
+        map.addLayer(crashLayer);
+
+        // Trip paths, each a list of indices into the flat lat/lon pool
+        function decodeFloat32(b64) {{
+            var bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+            var view = new DataView(bytes.buffer);
+            var values = new Float32Array(bytes.length / 4);
+            for (var i = 0; i < values.length; i++) {{
+                values[i] = view.getFloat32(4 * i, true);
+            }}
+            return values;
+        }}
+        var coordPool = decodeFloat32('"""
+
+    html_pool_end = f"""');
+        var tripPaths = """
+
+    html_tail = f""";
+
+        // One GeoJSON feature per trip (GeoJSON positions are lon/lat)
+        var tripFeatures = {{
+            type: 'FeatureCollection',
+            features: Object.entries(tripPaths).map(([tripId, indices]) => ({{
+                type: 'Feature',
+                properties: {{tripId: tripId}},
+                geometry: {{
+                    type: 'LineString',
+                    coordinates: indices.map(i => [coordPool[2 * i + 1], coordPool[2 * i]])
+                }}
+            }}))
+        }};
 
-        // Trip paths
-        var tripPaths = {{
-"""
-
-for trip_id, coords in trip_paths.items():
-    if len(coords) > 0:
-        coords_js = str(coords).replace("'", '"')
-        html += f"""            '{trip_id}': {coords_js},\n"""
-
-html += f"""        }};
-
-        // Draw paths
-        Object.entries(tripPaths).forEach(([tripId, coords]) => {{
-            if (coords.length > 1) {{
-                var path = L.polyline(coords, {{
-                    color: '#0066cc',
-                    weight: 2,
-                    opacity: 0.2
-                }}).addTo(map);
-
-                pathLayers[tripId] = {{
-                    layer: path,
-                    originalStyle: {{
-                        color: '#0066cc',
-                        weight: 2,
-                        opacity: 0.2
-                    }}
+        // Draw paths, one GeoJSON layer on the shared canvas
+        L.geoJSON(tripFeatures, {{
+            renderer: canvasRenderer,
+            style: PATH_STYLE,
+            onEachFeature: function(feature, layer) {{
+                pathLayers[feature.properties.tripId] = {{
+                    layer: layer,
+                    originalStyle: PATH_STYLE
                 }};
             }}
-        }});
+        }}).addTo(map);
 
         // Highlight crash and its vehicles
         function highlightCrash(crashId) {{
@@ -295,43 +388,23 @@ html += f"""        }};
             Object.entries(crashMarkers).forEach(([id, data]) => {{
                 if (id === crashId) {{
                     // Highlight selected crash
-                    data.marker.setStyle({{
-                        fillColor: data.originalStyle.fillColor,
-                        opacity: 1,
-                        fillOpacity: 1,
-                        weight: 4,
-                        color: '#fff'
-                    }});
+                    data.marker.setStyle(data.highlightStyle);
                     data.marker.bringToFront();
                 }} else {{
                     // Dim other crashes
-                    data.marker.setStyle({{
-                        fillColor: '#ccc',
-                        opacity: 0.3,
-                        fillOpacity: 0.3,
-                        weight: 1,
-                        color: '#999'
-                    }});
+                    data.marker.setStyle(CRASH_DIM_STYLE);
                 }}
             }});
 
             // Dim all paths
             Object.entries(pathLayers).forEach(([tripId, data]) => {{
-                if (selectedCrash.trip_ids.includes(tripId)) {{
+                if (selectedCrash.tripSet.has(tripId)) {{
                     // Highlight paths for this crash
-                    data.layer.setStyle({{
-                        color: '#ff00ff',
-                        weight: 3,
-                        opacity: 0.9
-                    }});
+                    data.layer.setStyle(PATH_HIGHLIGHT_STYLE);
                     data.layer.bringToFront();
                 }} else {{
                     // Dim other paths
-                    data.layer.setStyle({{
-                        color: '#ccc',
-                        weight: 1,
-                        opacity: 0.1
-                    }});
+                    data.layer.setStyle(PATH_DIM_STYLE);
                 }}
             }});
 
@@ -368,7 +441,7 @@ html += f"""        }};
         legend.onAdd = function (map) {{
             var div = L.DomUtil.create('div', 'legend');
             div.innerHTML = '<div class="legend-title">🚗 Interactive Crash Map</div>';
-            div.innerHTML += '<b>Total:</b> {len(matches)} vehicle observations<br>';
+            div.innerHTML += '<b>Total:</b> {map_data['num_matches']} vehicle observations<br>';
             div.innerHTML += '<b>Crashes:</b> {len(crashes_dict)} locations<br>';
             div.innerHTML += '<b>Time window:</b> ±5 minutes<br><br>';
 
@@ -393,15 +466,21 @@ html += f"""        }};
 </body>
 </html>"""
 
-output_file = 'interactive_crash_map.html'
-with open(output_file, 'w') as f:
-    f.write(html)
-
-print(f"\n✓ Interactive map created: {output_file}")
-print(f"\nFeatures:")
-print(f"  • Click any crash marker to highlight its vehicles")
-print(f"  • Magenta paths = vehicles for selected crash")
-print(f"  • All other crashes/paths dimmed")
-print(f"  • Click 'Clear Selection' to reset")
-print(f"  • Auto-zooms to selected crash")
-print(f"\nOpen in browser and click around!")
+    # Template pieces are written straight to the file around the JSON blobs,
+    # the page is never held as one string
+    output_file = 'interactive_crash_map.html'
+    with open(output_file, 'w') as f:
+        for part in (html_head, crashes_json, html_middle, coord_pool_b64, html_pool_end, trip_paths_json, html_tail):
+            f.write(part)
+
+    print(f"\n✓ Interactive map created: {output_file}")
+    print(f"\nFeatures:")
+    print(f"  • Click any crash marker to highlight its vehicles")
+    print(f"  • Magenta paths = vehicles for selected crash")
+    print(f"  • All other crashes/paths dimmed")
+    print(f"  • Click 'Clear Selection' to reset")
+    print(f"  • Auto-zooms to selected crash")
+    print(f"\nOpen in browser and click around!")
+
+if __name__ == "__main__":
+    main()
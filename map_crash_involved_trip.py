@@ -2,11 +2,41 @@
 """Map the LCV that stayed at crash scene for 13 minutes"""
 
 import csv
+import json
+import mmap
 import sys
 from datetime import datetime
+import numpy as np
+import pandas as pd
+from paths import parse_path
+from trip_index import cached_trip_index, read_trip_rows
 
 csv.field_size_limit(sys.maxsize)
 
+def search_trip_row(vfile, trip_id):
+    """Find the row for one TripID by searching the file's bytes, None if the file lacks it.
+
+    Only lines containing the TripID are parsed, so files without it are
+    skipped without any CSV parsing.
+    """
+    needle = trip_id.encode()
+    with open(vfile, 'rb') as f:
+        header = next(csv.reader([f.readline().decode()]))
+        trip_col = header.index('TripID')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(needle)
+            while pos != -1:
+                line_start = mm.rfind(b'\n', 0, pos) + 1
+                line_end = mm.find(b'\n', pos)
+                if line_end == -1:
+                    line_end = len(mm)
+                # The TripID may also turn up inside another field
+                row = next(csv.reader([mm[line_start:line_end].decode()]), [])
+                if len(row) > trip_col and row[trip_col] == trip_id:
+                    return dict(zip(header, row))
+                pos = mm.find(needle, line_end)
+    return None
+
 trip_id = "rLIyF5Bi7LvXW+GZSDgtXA=="
 crash_id = "2025315483"
 
@@ -16,16 +46,17 @@ print(f"Loading trip {trip_id}...")
 from pathlib import Path
 vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
 
-trip_data = None
-for vfile in vehicle_files:
-    with open(vfile, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['TripID'] == trip_id:
-                trip_data = row
-                break
-    if trip_data:
-        break
+# Seek straight to the row when the TripID index is current, otherwise search
+# the files for it rather than indexing every trip for one lookup
+trip_index = cached_trip_index(vehicle_files)
+if trip_index is not None:
+    trip_data = read_trip_rows(trip_index, [trip_id]).get(trip_id)
+else:
+    trip_data = None
+    for vfile in vehicle_files:
+        trip_data = search_trip_row(vfile, trip_id)
+        if trip_data:
+            break
 
 if not trip_data:
     print("Trip not found!")
@@ -33,24 +64,21 @@ if not trip_data:
 
 # Get crash data
 with open('crash_WITNESSES.csv', 'r') as f:
-    reader = csv.DictReader(f)
+    reader = csv.reader(f)
+    header = next(reader)
+    trip_col = header.index('trip_id')
     for row in reader:
-        if row['trip_id'] == trip_id:
-            crash_data = row
+        if row[trip_col] == trip_id:
+            crash_data = dict(zip(header, row))
             break
 
 # Parse paths
 timestamps = trip_data['TimestampPath'].split(',')
-raw_path = trip_data['RawPath'].split(',')
 speeds = trip_data['SpeedPath'].split(',')
 
-# Parse coordinates
-coords = []
-for point_str in raw_path:
-    parts = point_str.strip().split()
-    if len(parts) == 2:
-        lon, lat = float(parts[0]), float(parts[1])
-        coords.append((lat, lon))
+# Parse coordinates as (lat, lon) pairs
+coord_array = parse_path(trip_data['RawPath'])
+coords = coord_array.tolist()
 
 # Get crash location
 from pyproj import Transformer
@@ -67,31 +95,51 @@ crash_idx = int(crash_data['closest_point_idx'])
 crash_time = datetime.strptime(crash_data['crash_datetime'], "%Y-%m-%d %H:%M")
 
 # Find points near crash (within 50m, around crash time ±15 min)
-crash_scene_points = []
-for i in range(min(len(coords), len(timestamps))):
-    try:
-        ts = datetime.strptime(timestamps[i].split('.')[0], "%Y-%m-%d %H:%M:%S")
-        time_diff_min = abs((ts - crash_time).total_seconds() / 60)
-
-        # Within ±15 minutes of crash
-        if time_diff_min <= 15:
-            # Calculate distance using WGS84 to NZTM
-            # coords are (lat, lon) but transform expects (lon, lat)
-            px, py = transformer_to_nztm.transform(coords[i][1], coords[i][0])
-            crash_x = float(crash_data['crash_x'])
-            crash_y = float(crash_data['crash_y'])
-            dist = ((px - crash_x)**2 + (py - crash_y)**2)**0.5
-
-            if dist < 50:
-                crash_scene_points.append(i)
-    except:
-        pass
+num_checked = min(len(coords), len(timestamps))
+
+# Timestamps as datetime64 (NaT where unparseable), fractional seconds dropped
+ts_values = pd.to_datetime(pd.Series(timestamps[:num_checked]).str.split('.').str[0],
+                           format="%Y-%m-%d %H:%M:%S", errors='coerce')
+time_diff_min = ((ts_values - pd.Timestamp(crash_time)).abs().dt.total_seconds() / 60).to_numpy()
+
+# Points in the 0.001 degree grid cells (~100m) around the crash, within
+# ±15 minutes of it. A 50m radius never reaches past the neighbouring cells,
+# and NaT never qualifies
+lat_cells = np.floor(coord_array[:num_checked, 0] * 1000)
+lon_cells = np.floor(coord_array[:num_checked, 1] * 1000)
+near_cells = ((np.abs(lat_cells - np.floor(crash_lat_wgs * 1000)) <= 1)
+              & (np.abs(lon_cells - np.floor(crash_lon_wgs * 1000)) <= 1))
+candidates = np.flatnonzero(near_cells & (time_diff_min <= 15))
+
+# Distance using WGS84 to NZTM, only the candidates are projected
+# coords are (lat, lon) but transform expects (lon, lat)
+px, py = transformer_to_nztm.transform(coord_array[candidates, 1], coord_array[candidates, 0])
+crash_x = float(crash_data['crash_x'])
+crash_y = float(crash_data['crash_y'])
+dist = ((px - crash_x)**2 + (py - crash_y)**2)**0.5
+
+# Within 50m of the crash
+at_scene = np.zeros(num_checked, dtype=bool)
+at_scene[candidates[dist < 50]] = True
+crash_scene_points = np.flatnonzero(at_scene).tolist()
+at_scene = at_scene.tolist()
 
 print(f"Creating map with {len(coords)} GPS points...")
 print(f"Found {len(crash_scene_points)} points at crash scene (±15min of crash)")
 
+# GPS points are embedded as JSON
+points = []
+for i, ((lat, lon), ts, speed) in enumerate(zip(coords, timestamps, speeds)):
+    try:
+        speed_val = float(speed) if speed and speed != 'null' else 0
+    except:
+        speed_val = 0
+    points.append({'lat': lat, 'lon': lon, 'time': ts, 'speed': speed_val, 'idx': i,
+                   'atScene': at_scene[i]})
+points_json = json.dumps(points, separators=(',', ':'))
+
 # Create HTML map
-html = f"""<!DOCTYPE html>
+html_head = f"""<!DOCTYPE html>
 <html>
 <head>
     <title>Crash-Involved Vehicle - Trip {trip_id[:10]}</title>
@@ -115,7 +163,10 @@ html = f"""<!DOCTYPE html>
 <body>
     <div id="map"></div>
     <script>
-        var map = L.map('map').setView([{coords[crash_idx][0]}, {coords[crash_idx][1]}], 16);
+        var map = L.map('map', {{preferCanvas: true}}).setView([{coords[crash_idx][0]}, {coords[crash_idx][1]}], 16);
+
+        // Markers are drawn on one canvas rather than as SVG elements
+        var canvasRenderer = L.canvas({{padding: 0.5}});
 
         L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
             attribution: '© OpenStreetMap contributors'
@@ -133,26 +184,17 @@ html = f"""<!DOCTYPE html>
                                 '#ff0000';
         }}
 
-        var crashSceneIndices = {crash_scene_points};
+        var crashSceneIndices = {json.dumps(crash_scene_points)};
 
-        var points = [
-"""
-
-# Add GPS points
-for i, ((lat, lon), ts, speed) in enumerate(zip(coords, timestamps, speeds)):
-    try:
-        speed_val = float(speed) if speed and speed != 'null' else 0
-    except:
-        speed_val = 0
-    at_scene = 'true' if i in crash_scene_points else 'false'
-    html += f"""            {{lat: {lat}, lon: {lon}, time: '{ts}', speed: {speed_val}, idx: {i}, atScene: {at_scene}}},\n"""
+        var points = """
 
-html += f"""        ];
+html_tail = f""";
 
         points.forEach(function(point, idx) {{
             var color = getColor(point.speed, point.atScene);
             var radius = point.atScene ? 8 : 4;  // Larger for crash scene points
             var marker = L.circleMarker([point.lat, point.lon], {{
+                renderer: canvasRenderer,
                 radius: radius,
                 fillColor: color,
                 color: point.atScene ? '#ff00ff' : '#000',
@@ -253,10 +295,11 @@ html += f"""        ];
 </body>
 </html>"""
 
-# Write HTML file
+# Write HTML file, piece by piece around the points JSON
 output_file = f'crash_involved_LCV_{trip_id[:10]}.html'
 with open(output_file, 'w') as f:
-    f.write(html)
+    for part in (html_head, points_json, html_tail):
+        f.write(part)
 
 print(f"\n✓ Map created: {output_file}")
 print(f"\nMap features:")
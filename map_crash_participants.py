@@ -7,131 +7,244 @@ Highlight them differently from witnesses and emergency responders.
 import csv
 import sys
 import json
+import warnings
 from pathlib import Path
 from collections import defaultdict
+import numpy as np
 from pyproj import Transformer
+from paths import parse_points
+from trip_index import load_trip_index, read_trip_rows
 
 csv.field_size_limit(sys.maxsize)
 
-print("Loading crash participants...")
-
-# Load crash participants
-participants = []
-with open('crash_participants.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    participants = list(reader)
-
-print(f"Loaded {len(participants)} crash participants")
-
-# Group by crash
-crashes_dict = {}
-crash_to_trips = defaultdict(list)
-
-for p in participants:
-    crash_id = p['nzta_crash_id']
-    trip_id = p['trip_id']
-
-    crash_to_trips[crash_id].append(trip_id)
-
-    if crash_id not in crashes_dict:
-        crashes_dict[crash_id] = {
-            'crash_id': crash_id,
-            'lat': None,
-            'lon': None,
-            'severity': p['nzta_severity'],
-            'location': p['nzta_location'],
-            'road': p['nzta_road'],
-            'datetime': p['crash_datetime'],
-            'vehicles': []
-        }
-    crashes_dict[crash_id]['vehicles'].append(p)
-
-# Get crash coordinates
-transformer = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
-
-for crash_id, crash_data in crashes_dict.items():
-    match = crash_data['vehicles'][0]
-    crash_lon, crash_lat = transformer.transform(
-        float(match['crash_x']),
-        float(match['crash_y'])
-    )
-    crash_data['lat'] = crash_lat
-    crash_data['lon'] = crash_lon
-
-print(f"Unique crashes with participants: {len(crashes_dict)}")
-
-# Load trip paths
-print("\nLoading trip paths with speed data...")
-vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
-
-trip_data_full = {}
-trips_needed = set([p['trip_id'] for p in participants])
-
-loaded = 0
-for vfile in vehicle_files:
-    if not trips_needed:
-        break
-
-    with open(vfile, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['TripID'] in trips_needed:
-                raw_path = row['RawPath'].split(',')
-                speed_path = row['SpeedPath'].split(',')
-                timestamp_path = row['TimestampPath'].split(',')
-
-                coords = []
-                speeds = []
-                timestamps = []
-
-                for i, point_str in enumerate(raw_path):
-                    parts = point_str.strip().split()
-                    if len(parts) == 2:
-                        lon, lat = float(parts[0]), float(parts[1])
-                        coords.append([lat, lon])
-
-                        try:
-                            speed = float(speed_path[i]) if i < len(speed_path) and speed_path[i] not in ['', 'null'] else 0
-                        except:
-                            speed = 0
-                        speeds.append(speed)
-
-                        ts = timestamp_path[i] if i < len(timestamp_path) else ''
-                        timestamps.append(ts)
-
-                trip_data_full[row['TripID']] = {
-                    'coords': coords,
-                    'speeds': speeds,
-                    'timestamps': timestamps,
-                    'vehicle_type': row['VehicleType'],
-                    'max_speed': row['SpeedMax'],
-                    'avg_speed': row['SpeedAvg']
+def parse_speeds(speed_path):
+    """Parse a SpeedPath string into floats, missing or 'null' readings as 0"""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(speed_path.replace('null', 'nan').replace(',', ' '), sep=' ')
+        # Empty readings collapse when split on whitespace, so check the count
+        if len(values) == speed_path.count(',') + 1:
+            values[np.isnan(values)] = 0
+            return values
+    except (ValueError, DeprecationWarning):
+        pass
+
+    speeds = []
+    for speed_str in speed_path.split(','):
+        try:
+            speeds.append(float(speed_str) if speed_str not in ['', 'null'] else 0)
+        except:
+            speeds.append(0)
+    return np.array(speeds, dtype=np.float64)
+
+def parse_trip_paths(raw_paths, speed_paths):
+    """Lat/lon points and speeds for many trips, one np.fromstring call per column.
+
+    Each trip is split back out by its comma count. When a column's total does not
+    match, some trip is malformed and that column is parsed trip by trip instead.
+    """
+    point_counts = [raw_path.count(',') + 1 for raw_path in raw_paths]
+    speed_counts = [speed_path.count(',') + 1 for speed_path in speed_paths]
+
+    points = None
+    speeds = None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(','.join(raw_paths).replace(',', ' '), sep=' ')
+        if len(values) == 2 * sum(point_counts):
+            coords = values.reshape(-1, 2)[:, ::-1]
+            points = [(trip_coords, np.arange(len(trip_coords)))
+                      for trip_coords in np.split(coords, np.cumsum(point_counts)[:-1])]
+    except (ValueError, DeprecationWarning):
+        pass
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(','.join(speed_paths).replace('null', 'nan').replace(',', ' '), sep=' ')
+        if len(values) == sum(speed_counts):
+            values[np.isnan(values)] = 0
+            speeds = np.split(values, np.cumsum(speed_counts)[:-1])
+    except (ValueError, DeprecationWarning):
+        pass
+
+    if points is None:
+        points = [(coords[:, ::-1], positions) for coords, positions in map(parse_points, raw_paths)]
+    if speeds is None:
+        speeds = [parse_speeds(speed_path) for speed_path in speed_paths]
+    return points, speeds
+
+def optional_float(value):
+    """Parse an optional CSV field, None when it is empty or not a number"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def main():
+    print("Loading crash participants...")
+
+    # Load crash participants, grouping them by crash as they are read
+    crashes_dict = {}
+    crash_to_trips = defaultdict(list)
+    n_participants = 0
+
+    with open('crash_participants.csv', 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        # Participant rows are kept as lists, read through these column positions
+        col = {name: i for i, name in enumerate(header)}
+
+        for p in reader:
+            if not p:
+                continue
+            n_participants += 1
+            crash_id = p[col['nzta_crash_id']]
+
+            crash_to_trips[crash_id].append(p[col['trip_id']])
+
+            if crash_id not in crashes_dict:
+                crashes_dict[crash_id] = {
+                    'crash_id': crash_id,
+                    'lat': None,
+                    'lon': None,
+                    'severity': p[col['nzta_severity']],
+                    'location': p[col['nzta_location']],
+                    'road': p[col['nzta_road']],
+                    'datetime': p[col['crash_datetime']],
+                    'vehicles': []
                 }
+            crashes_dict[crash_id]['vehicles'].append(p)
+
+    print(f"Loaded {n_participants} crash participants")
+
+    # Get crash coordinates
+    transformer = Transformer.from_crs("EPSG:2193", "EPSG:4326", always_xy=True)
+
+    # First participant of each crash gives its coords, projected in one call
+    crash_xs = np.fromiter((float(c['vehicles'][0][col['crash_x']]) for c in crashes_dict.values()),
+                           dtype=np.float64, count=len(crashes_dict))
+    crash_ys = np.fromiter((float(c['vehicles'][0][col['crash_y']]) for c in crashes_dict.values()),
+                           dtype=np.float64, count=len(crashes_dict))
+    crash_lons, crash_lats = transformer.transform(crash_xs, crash_ys)
+
+    for crash_data, crash_lat, crash_lon in zip(crashes_dict.values(), crash_lats.tolist(), crash_lons.tolist()):
+        crash_data['lat'] = crash_lat
+        crash_data['lon'] = crash_lon
+
+    print(f"Unique crashes with participants: {len(crashes_dict)}")
+
+    # Load trip paths
+    print("\nLoading trip paths with speed data...")
+    vehicle_files = list(Path('data/connected_vehicle').glob('support.NZ_report_withOD-*.csv'))
+
+    trip_data_full = {}
+    trips_needed = {trip_id for trip_ids in crash_to_trips.values() for trip_id in trip_ids}
+
+    # Seek straight to each needed trip, keeping the order of a sequential scan
+    trip_index = load_trip_index(vehicle_files)
+    trip_rows = read_trip_rows(trip_index, trips_needed)
+    file_order = {str(vfile): i for i, vfile in enumerate(vehicle_files)}
+    scan_order = sorted(trip_rows, key=lambda t: (file_order[trip_index[t][0]], trip_index[t][1]))
+    rows = [trip_rows[trip_id] for trip_id in scan_order]
+    points, speed_paths = parse_trip_paths([row['RawPath'] for row in rows], [row['SpeedPath'] for row in rows])
+
+    loaded = 0
+    for trip_id, row, (coords, positions), speed_values in zip(scan_order, rows, points, speed_paths):
+        timestamp_path = row['TimestampPath'].split(',')
+
+        # Speed and timestamp of each point, 0 and '' past the end of those paths
+        speeds = np.zeros(len(positions))
+        in_range = positions < len(speed_values)
+        speeds[in_range] = speed_values[positions[in_range]]
+        # Timestamps are kept to the second, fractional seconds are dropped here once
+        timestamps = [timestamp_path[i].partition('.')[0] if i < len(timestamp_path) else '' for i in positions.tolist()]
+
+        trip_data_full[trip_id] = {
+            'coords': coords.tolist(),
+            'speeds': speeds.tolist(),
+            'timestamps': timestamps,
+            'vehicle_type': row['VehicleType'],
+            'max_speed': row['SpeedMax'],
+            'avg_speed': row['SpeedAvg']
+        }
+        loaded += 1
+
+        if loaded % 10 == 0:
+            print(f"  Loaded {loaded} trips...")
+
+    print(f"Loaded {len(trip_data_full)} participant trip paths")
+
+    # Create HTML map
+    print("\nGenerating crash participant map...")
+
+    all_lats = [c['lat'] for c in crashes_dict.values()]
+    all_lons = [c['lon'] for c in crashes_dict.values()]
+    center_lat = sum(all_lats) / len(all_lats)
+    center_lon = sum(all_lons) / len(all_lons)
+
+    severity_colors = {
+        'Fatal Crash': '#8B0000',
+        'Serious Crash': '#FF4500',
+        'Minor Crash': '#FFA500',
+        'Non-Injury Crash': '#FFD700'
+    }
+
+    crashes_list = []
+    for crash_id, crash in crashes_dict.items():
+        num_vehicles = len(crash['vehicles'])
+        color = severity_colors.get(crash['severity'], '#999')
+        trip_ids = crash_to_trips[crash_id]
+
+        vehicles_info = []
+        for v in crash['vehicles']:
+            vehicles_info.append({
+                'trip_id': v[col['trip_id']],
+                'vehicle_type': v[col['vehicle_type']],
+                'distance': float(v[col['distance_to_crash']]),
+                'time_diff': float(v[col['time_diff_minutes']]),
+                'score': float(v[col['combined_score']]),
+                'speed_at_point': optional_float(v[col['speed_at_point']]),
+                'x_accel_at_point': optional_float(v[col['x_accel_at_point']]),
+                'trip_speed_max': optional_float(v[col['trip_speed_max']]),
+                'trip_speed_avg': optional_float(v[col['trip_speed_avg']]),
+                'closest_timestamp': v[col['closest_timestamp']],
+                'sudden_deceleration': v[col['sudden_deceleration']]
+            })
+
+        crashes_list.append({
+            'lat': crash['lat'],
+            'lon': crash['lon'],
+            'id': crash_id,
+            'severity': crash['severity'],
+            'location': crash['location'],
+            'road': crash['road'],
+            'datetime': crash['datetime'],
+            'color': color,
+            'num_vehicles': num_vehicles,
+            'trip_ids': trip_ids,
+            'vehicles': vehicles_info
+        })
 
-                trips_needed.remove(row['TripID'])
-                loaded += 1
-
-                if loaded % 10 == 0:
-                    print(f"  Loaded {loaded} trips...")
-
-print(f"Loaded {len(trip_data_full)} participant trip paths")
-
-# Create HTML map
-print("\nGenerating crash participant map...")
-
-all_lats = [c['lat'] for c in crashes_dict.values()]
-all_lons = [c['lon'] for c in crashes_dict.values()]
-center_lat = sum(all_lats) / len(all_lats)
-center_lon = sum(all_lons) / len(all_lons)
+    trip_data = {}
+    for trip_id, data in trip_data_full.items():
+        trip_data[trip_id] = {
+            'coords': data['coords'],
+            'speeds': data['speeds'],
+            'timestamps': data['timestamps'],
+            'vehicle_type': data['vehicle_type'],
+            'max_speed': optional_float(data['max_speed']),
+            'avg_speed': optional_float(data['avg_speed'])
+        }
 
-severity_colors = {
-    'Fatal Crash': '#8B0000',
-    'Serious Crash': '#FF4500',
-    'Minor Crash': '#FFA500',
-    'Non-Injury Crash': '#FFD700'
-}
+    # Serialize each payload in one call, JSON is a valid JS literal
+    crashes_json = json.dumps(crashes_list, separators=(',', ':'))
+    trip_data_json = json.dumps(trip_data, separators=(',', ':'))
 
-html = f"""<!DOCTYPE html>
+    html_head = f"""<!DOCTYPE html>
 <html>
 <head>
     <title>Crash Participants - Auckland 2025</title>
@@ -249,56 +362,9 @@ html = f"""<!DOCTYPE html>
                                 '#c0392b';
         }}
 
-        var crashes = [
-"""
-
-for crash_id, crash in crashes_dict.items():
-    num_vehicles = len(crash['vehicles'])
-    color = severity_colors.get(crash['severity'], '#999')
-    trip_ids = crash_to_trips[crash_id]
+        var crashes = """
 
-    vehicles_info = []
-    for v in crash['vehicles']:
-        try:
-            speed_at = float(v['speed_at_point']) if v['speed_at_point'] and v['speed_at_point'] != '' else None
-        except:
-            speed_at = None
-
-        try:
-            accel_at = float(v['x_accel_at_point']) if v['x_accel_at_point'] and v['x_accel_at_point'] != '' else None
-        except:
-            accel_at = None
-
-        vehicles_info.append({
-            'trip_id': v['trip_id'],
-            'vehicle_type': v['vehicle_type'],
-            'distance': float(v['distance_to_crash']),
-            'time_diff': float(v['time_diff_minutes']),
-            'score': float(v['combined_score']),
-            'speed_at_point': speed_at,
-            'x_accel_at_point': accel_at,
-            'trip_speed_max': float(v['trip_speed_max']) if v['trip_speed_max'] else None,
-            'trip_speed_avg': float(v['trip_speed_avg']) if v['trip_speed_avg'] else None,
-            'closest_timestamp': v['closest_timestamp'],
-            'sudden_deceleration': v['sudden_deceleration']
-        })
-
-    html += f"""            {{
-                lat: {crash['lat']},
-                lon: {crash['lon']},
-                id: '{crash_id}',
-                severity: '{crash['severity']}',
-                location: '{crash['location']}',
-                road: '{crash['road']}',
-                datetime: '{crash['datetime']}',
-                color: '{color}',
-                num_vehicles: {num_vehicles},
-                trip_ids: {json.dumps(trip_ids)},
-                vehicles: {json.dumps(vehicles_info)}
-            }},
-"""
-
-html += f"""        ];
+    html_middle = f""";
 
         crashes.forEach(function(crash) {{
             var marker = L.circleMarker([crash.lat, crash.lon], {{
@@ -329,25 +395,9 @@ html += f"""        ];
             }};
         }});
 
-        var tripData = {{
-"""
-
-for trip_id, data in trip_data_full.items():
-    coords_js = str(data['coords']).replace("'", '"')
-    speeds_js = str(data['speeds'])
-    timestamps_js = str([ts.split('.')[0] if '.' in ts else ts for ts in data['timestamps']]).replace("'", '"')
-
-    html += f"""            '{trip_id}': {{
-                coords: {coords_js},
-                speeds: {speeds_js},
-                timestamps: {timestamps_js},
-                vehicle_type: '{data['vehicle_type']}',
-                max_speed: {data['max_speed']},
-                avg_speed: {data['avg_speed']}
-            }},
-"""
+        var tripData = """
 
-html += f"""        }};
+    html_tail = f""";
 
         Object.entries(tripData).forEach(([tripId, data]) => {{
             if (data.coords.length > 1) {{
@@ -597,7 +647,7 @@ html += f"""        }};
             var div = L.DomUtil.create('div', 'legend');
             div.innerHTML = '<div class="legend-title">Crash Participants</div>';
             div.innerHTML += '<b>Total Crashes:</b> {len(crashes_dict)}<br>';
-            div.innerHTML += '<b>Total Participants:</b> {len(participants)}<br>';
+            div.innerHTML += '<b>Total Participants:</b> {n_participants}<br>';
             div.innerHTML += '<b>Classification:</b> Likely crash-involved<br><br>';
 
             div.innerHTML += '<b>Crash Severity</b><br>';
@@ -624,16 +674,21 @@ html += f"""        }};
 </body>
 </html>"""
 
-output_file = 'crash_participants_map.html'
-with open(output_file, 'w') as f:
-    f.write(html)
-
-print(f"\nMap created: {output_file}")
-print(f"\nMap features:")
-print(f"  - {len(crashes_dict)} crashes with participant vehicles")
-print(f"  - {len(participants)} total crash participants")
-print(f"  - Red crash markers and vehicle paths")
-print(f"  - Speed-colored path segments when crash selected")
-print(f"  - Detailed participant data in info panel")
-print(f"  - Sudden deceleration indicators")
-print(f"\nOpen {output_file} in browser to explore!")
+    # Write HTML file, piece by piece around the crash and trip JSON
+    output_file = 'crash_participants_map.html'
+    with open(output_file, 'w') as f:
+        for part in (html_head, crashes_json, html_middle, trip_data_json, html_tail):
+            f.write(part)
+
+    print(f"\nMap created: {output_file}")
+    print(f"\nMap features:")
+    print(f"  - {len(crashes_dict)} crashes with participant vehicles")
+    print(f"  - {n_participants} total crash participants")
+    print(f"  - Red crash markers and vehicle paths")
+    print(f"  - Speed-colored path segments when crash selected")
+    print(f"  - Detailed participant data in info panel")
+    print(f"  - Sudden deceleration indicators")
+    print(f"\nOpen {output_file} in browser to explore!")
+
+if __name__ == "__main__":
+    main()
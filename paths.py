@@ -0,0 +1,36 @@
+"""
+Parsing of the connected vehicle RawPath column.
+A RawPath is a comma separated list of 'lon lat' points.
+"""
+
+import warnings
+import numpy as np
+
+def parse_points(raw_path):
+    """Parse a RawPath string into an (N, 2) array of lon/lat and each point's position in the path"""
+    try:
+        with warnings.catch_warnings():
+            # Malformed text only warns in np.fromstring, treat it as unparseable
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(raw_path.replace(',', ' '), sep=' ')
+        if len(values) == 2 * (raw_path.count(',') + 1):
+            return values.reshape(-1, 2), np.arange(len(values) // 2)
+    except (ValueError, DeprecationWarning):
+        pass
+
+    # Point by point so only malformed points are dropped
+    coords = []
+    positions = []
+    for i, point_str in enumerate(raw_path.split(',')):
+        parts = point_str.split()
+        if len(parts) == 2:
+            try:
+                coords.append((float(parts[0]), float(parts[1])))
+            except ValueError:
+                continue
+            positions.append(i)
+    return np.array(coords, dtype=np.float64).reshape(-1, 2), np.array(positions, dtype=np.intp)
+
+def parse_path(raw_path):
+    """Parse a RawPath string into an (N, 2) array of lat/lon"""
+    return parse_points(raw_path)[0][:, ::-1]
@@ -9,34 +9,38 @@ import sys
 from datetime import datetime, timedelta
 from collections import defaultdict
 import math
+import numpy as np
+import pandas as pd
 
 csv.field_size_limit(sys.maxsize)
 
-def parse_crash_datetime(date_str, time_str):
-    """Parse crash date and time into datetime object"""
-    try:
-        date_part = date_str.split()[0]  # "2025-01-04 00:00:00" -> "2025-01-04"
-        dt_str = f"{date_part} {time_str}"
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-    except:
-        return None
-
-def parse_vehicle_timestamp(ts_str):
-    """Parse vehicle timestamp"""
-    try:
-        # Format: "2025-01-04 12:34:56.123"
-        if '.' in ts_str:
-            ts_str = ts_str.split('.')[0]
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def time_delta_minutes(dt1, dt2):
-    """Calculate time difference in minutes"""
-    if not dt1 or not dt2:
-        return None
-    delta = abs((dt1 - dt2).total_seconds() / 60)
-    return delta
+# Columns each temporal match adds to its spatial match row, in the order they are set
+SCORE_FIELDS = [
+    'crash_datetime', 'vehicle_timestamp', 'time_diff_minutes', 'spatial_score',
+    'temporal_score', 'combined_score', 'crash_severity', 'crash_location', 'crash_road'
+]
+
+def output_fields(match_fields):
+    """Output column order: the spatial match columns, then any score column not already among them"""
+    return list(match_fields) + [field for field in SCORE_FIELDS if field not in match_fields]
+
+def to_datetime_list(timestamps):
+    """Convert a datetime64 Series to a list of datetime objects (None where NaT)"""
+    return timestamps.to_numpy(dtype='datetime64[us]').astype(object).tolist()
+
+def parse_crash_datetimes(dates, times):
+    """Parse crash date and time columns into datetime objects in one pass"""
+    date_part = pd.Series(dates, dtype=str).str.split().str[0]  # "2025-01-04 00:00:00" -> "2025-01-04"
+    parsed = pd.to_datetime(date_part + ' ' + pd.Series(times, dtype=str), format="%Y-%m-%d %H:%M",
+                            errors='coerce', cache=True)
+    return to_datetime_list(parsed)
+
+def parse_vehicle_timestamps(timestamps):
+    """Parse vehicle timestamps in one pass"""
+    # Format: "2025-01-04 12:34:56.123"
+    seconds = pd.Series(timestamps, dtype=str).str.split('.').str[0]
+    parsed = pd.to_datetime(seconds, format="%Y-%m-%d %H:%M:%S", errors='coerce', cache=True)
+    return to_datetime_list(parsed)
 
 def map_vehicle_type(connected_type, crash_type):
     """Score vehicle type match (0-1)"""
@@ -92,21 +96,26 @@ def load_crash_data():
 
     crashes = {}
     with open('data/crash_data/crash_Untitled_query.2025-10-13.11-58.csv', 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            crash_id = row['Crash identifier']
-            crashes[crash_id] = {
-                'crash_id': crash_id,
-                'datetime': parse_crash_datetime(row['Crash date'], row['Crash time']),
-                'date': row['Crash date'],
-                'time': row['Crash time'],
-                'severity': row['Crash severity'],
-                'lat': float(row['Latitude']) if row['Latitude'] else None,
-                'lon': float(row['Longitude']) if row['Longitude'] else None,
-                'location': row.get('Locality/suburb', ''),
-                'road': row.get('Geospatial road name', ''),
-                'num_vehicles': row.get('Number of vehicles involved', '0')
-            }
+        rows = list(csv.DictReader(f))
+
+    # Parse all crash datetimes at once rather than one strptime call per row
+    crash_datetimes = parse_crash_datetimes([row['Crash date'] for row in rows],
+                                            [row['Crash time'] for row in rows])
+
+    for row, crash_datetime in zip(rows, crash_datetimes):
+        crash_id = row['Crash identifier']
+        crashes[crash_id] = {
+            'crash_id': crash_id,
+            'datetime': crash_datetime,
+            'date': row['Crash date'],
+            'time': row['Crash time'],
+            'severity': row['Crash severity'],
+            'lat': float(row['Latitude']) if row['Latitude'] else None,
+            'lon': float(row['Longitude']) if row['Longitude'] else None,
+            'location': row.get('Locality/suburb', ''),
+            'road': row.get('Geospatial road name', ''),
+            'num_vehicles': row.get('Number of vehicles involved', '0')
+        }
 
     print(f"Loaded {len(crashes)} crashes")
 
@@ -139,17 +148,31 @@ def load_spatial_matches():
         reader = csv.DictReader(f)
         for row in reader:
             matches.append(row)
+        match_fields = reader.fieldnames or []
 
     print(f"Loaded {len(matches):,} spatial matches")
-    return matches
+    return matches, match_fields
 
-def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
-    """Add temporal validation and scoring"""
+def temporal_match(spatial_matches, crashes, out_fields, time_windows=[5, 10, 15, 20]):
+    """Add temporal validation and scoring, each match a tuple in out_fields order"""
     print("\n" + "="*80)
     print("TEMPORAL-SPATIAL MATCHING")
     print("="*80)
 
     results_by_window = {}
+    distance_col = out_fields.index('distance_to_crash')
+    time_diff_col = out_fields.index('time_diff_minutes')
+
+    # Parse every vehicle timestamp once up front; the window loops reuse them
+    vehicle_timestamps = parse_vehicle_timestamps(
+        [match.get('closest_timestamp', '') for match in spatial_matches])
+
+    # Minutes between crash and vehicle timestamp for every match in one datetime64
+    # subtraction (NaN where either is missing or the crash is unknown)
+    crash_dts = np.array([crashes.get(str(match['crash_id']), {}).get('datetime') for match in spatial_matches],
+                         dtype='datetime64[s]')
+    vehicle_dts = np.array(vehicle_timestamps, dtype='datetime64[s]')
+    time_diffs_min = np.abs(crash_dts - vehicle_dts) / np.timedelta64(60, 's')
 
     for time_window in time_windows:
         print(f"\n--- Time window: ±{time_window} minutes ---")
@@ -174,14 +197,14 @@ def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
                 continue
 
             # Parse vehicle timestamp
-            vehicle_ts = parse_vehicle_timestamp(match.get('closest_timestamp', ''))
+            vehicle_ts = vehicle_timestamps[i]
             if not vehicle_ts:
                 skipped_no_time += 1
                 continue
 
             # Calculate time delta
-            time_diff = time_delta_minutes(crash['datetime'], vehicle_ts)
-            if time_diff is None or time_diff > time_window:
+            time_diff = float(time_diffs_min[i])
+            if time_diff > time_window:
                 continue
 
             # Match found! Calculate enhanced scores
@@ -198,8 +221,7 @@ def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
             # Combined score
             combined_score = spatial_score * 0.6 + temporal_score * 0.4
 
-            matched.append({
-                **match,
+            scores = {
                 'crash_datetime': crash['datetime'].strftime('%Y-%m-%d %H:%M'),
                 'vehicle_timestamp': vehicle_ts.strftime('%Y-%m-%d %H:%M:%S'),
                 'time_diff_minutes': round(time_diff, 2),
@@ -209,7 +231,8 @@ def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
                 'crash_severity': crash['severity'],
                 'crash_location': crash['location'],
                 'crash_road': crash['road']
-            })
+            }
+            matched.append(tuple(scores[field] if field in scores else match[field] for field in out_fields))
 
         print(f"\n  Matches found: {len(matched):,}")
         print(f"  Skipped (no timestamp): {skipped_no_time:,}")
@@ -217,11 +240,11 @@ def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
 
         if len(matched) > 0:
             # Stats
-            time_diffs = [m['time_diff_minutes'] for m in matched]
+            time_diffs = [m[time_diff_col] for m in matched]
             print(f"  Time difference - Mean: {sum(time_diffs)/len(time_diffs):.2f} min, "
                   f"Median: {sorted(time_diffs)[len(time_diffs)//2]:.2f} min")
 
-            distances = [float(m['distance_to_crash']) for m in matched]
+            distances = [float(m[distance_col]) for m in matched]
             print(f"  Distance - Mean: {sum(distances)/len(distances):.2f} m, "
                   f"Median: {sorted(distances)[len(distances)//2]:.2f} m")
 
@@ -229,12 +252,14 @@ def temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20]):
 
     return results_by_window
 
-def export_results(results_by_window):
+def export_results(results_by_window, out_fields):
     """Export matched results"""
     print("\n" + "="*80)
     print("EXPORTING RESULTS")
     print("="*80)
 
+    combined_score_col = out_fields.index('combined_score')
+
     for time_window, matches in results_by_window.items():
         if len(matches) == 0:
             continue
@@ -242,35 +267,37 @@ def export_results(results_by_window):
         filename = f'temporal_spatial_matches_{time_window}min.csv'
 
         with open(filename, 'w', newline='') as f:
-            if len(matches) > 0:
-                writer = csv.DictWriter(f, fieldnames=matches[0].keys())
-                writer.writeheader()
+            # An empty window leaves an empty file, with no header
+            if matches:
+                writer = csv.writer(f)
+                writer.writerow(out_fields)
                 writer.writerows(matches)
 
         print(f"  {filename}: {len(matches):,} matches")
 
         # High confidence subset (top 25%)
-        sorted_matches = sorted(matches, key=lambda x: x['combined_score'], reverse=True)
+        sorted_matches = sorted(matches, key=lambda x: x[combined_score_col], reverse=True)
         high_conf = sorted_matches[:len(sorted_matches)//4]
 
         if len(high_conf) > 0:
             hc_filename = f'temporal_spatial_matches_{time_window}min_high_confidence.csv'
             with open(hc_filename, 'w', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=high_conf[0].keys())
-                writer.writeheader()
+                writer = csv.writer(f)
+                writer.writerow(out_fields)
                 writer.writerows(high_conf)
             print(f"  {hc_filename}: {len(high_conf):,} matches (top 25%)")
 
 def main():
     # Load data
     crashes, crash_vehicles = load_crash_data()
-    spatial_matches = load_spatial_matches()
+    spatial_matches, match_fields = load_spatial_matches()
+    out_fields = output_fields(match_fields)
 
     # Progressive temporal matching
-    results = temporal_match(spatial_matches, crashes, time_windows=[5, 10, 15, 20])
+    results = temporal_match(spatial_matches, crashes, out_fields, time_windows=[5, 10, 15, 20])
 
     # Export
-    export_results(results)
+    export_results(results, out_fields)
 
     print("\n" + "="*80)
     print("COMPLETE")
@@ -0,0 +1,163 @@
+"""
+TripID index over the connected vehicle files.
+Maps every TripID to the file and byte offset of its row, so scripts can
+seek straight to the trips they need instead of reading whole files.
+Also the column reads and on-disk caches for scripts that scan the files for
+a set of trips.
+"""
+
+import csv
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    # Multithreaded CSV parsing when pyarrow is installed
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+csv.field_size_limit(sys.maxsize)
+
+TRIP_INDEX_FILE = 'trip_index.pkl'
+
+# Bumped whenever how the index is built changes, so older index files are rebuilt
+TRIP_INDEX_VERSION = 2
+
+# Bytes of a vehicle file scanned for newlines at a time
+NEWLINE_BLOCK_SIZE = 64 * 1024 * 1024
+
+def line_starts(vfile):
+    """Byte offsets of the lines after the first, found by scanning the memory-mapped file in blocks"""
+    data = np.memmap(vfile, dtype=np.uint8, mode='r')
+    starts = [np.flatnonzero(data[begin:begin + NEWLINE_BLOCK_SIZE] == ord('\n')) + (begin + 1)
+              for begin in range(0, len(data), NEWLINE_BLOCK_SIZE)]
+    starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.intp)
+    return starts[starts < len(data)]
+
+def index_vehicle_file(vfile):
+    """Map every TripID in one vehicle file to (file, byte offset of its row)"""
+    file_index = {}
+
+    # Only the TripID column is parsed, and when every row is one line the
+    # offsets are just the line starts after the header
+    trip_ids = pd.read_csv(vfile, usecols=['TripID'], dtype=str, keep_default_na=False, engine=CSV_ENGINE)['TripID']
+    offsets = line_starts(vfile)
+    if len(offsets) == len(trip_ids):
+        for trip_id, offset in zip(trip_ids.tolist(), offsets.tolist()):
+            file_index.setdefault(trip_id, (str(vfile), offset))
+        return file_index
+
+    # Blank lines or quoted line breaks, walk the rows with the csv module
+    with open(vfile, 'rb') as f:
+        header = next(csv.reader([f.readline().decode()]))
+        trip_col = header.index('TripID')
+
+        # One reader for the whole file, fed line by line so the byte offset
+        # where each row starts is known
+        end = [f.tell()]
+        def lines():
+            for line in f:
+                end[0] += len(line)
+                yield line.decode()
+
+        row_start = end[0]
+        for row in csv.reader(lines()):
+            if row:
+                file_index.setdefault(row[trip_col], (str(vfile), row_start))
+            row_start = end[0]
+    return file_index
+
+def build_trip_index(vehicle_files):
+    """Map every TripID to (file, byte offset of its row), indexing the vehicle files in parallel"""
+    trip_index = {}
+    with ProcessPoolExecutor() as executor:
+        for file_index in executor.map(index_vehicle_file, vehicle_files):
+            for trip_id, location in file_index.items():
+                # First occurrence wins, as in a sequential scan
+                trip_index.setdefault(trip_id, location)
+    return trip_index
+
+def cached_trip_index(vehicle_files):
+    """The TripID index from disk, or None when it is missing, outdated or any vehicle file has changed"""
+    mtimes = {str(vfile): os.stat(vfile).st_mtime for vfile in vehicle_files}
+    try:
+        with open(TRIP_INDEX_FILE, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') == TRIP_INDEX_VERSION and cached['mtimes'] == mtimes:
+            return cached['trips']
+    except (OSError, EOFError, KeyError, AttributeError, pickle.UnpicklingError):
+        pass
+    return None
+
+def load_trip_index(vehicle_files):
+    """Load the TripID index from disk, rebuilding it when it is outdated or any vehicle file has changed"""
+    trip_index = cached_trip_index(vehicle_files)
+    if trip_index is not None:
+        return trip_index
+
+    print("  Building trip index (first run only)...")
+    mtimes = {str(vfile): os.stat(vfile).st_mtime for vfile in vehicle_files}
+    trip_index = build_trip_index(vehicle_files)
+    with open(TRIP_INDEX_FILE, 'wb') as f:
+        pickle.dump({'version': TRIP_INDEX_VERSION, 'mtimes': mtimes, 'trips': trip_index}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    return trip_index
+
+def read_trip_rows(trip_index, trip_ids):
+    """Read the rows for the given TripIDs by seeking straight to them"""
+    by_file = defaultdict(list)
+    for trip_id in trip_ids:
+        if trip_id in trip_index:
+            vfile, offset = trip_index[trip_id]
+            by_file[vfile].append((offset, trip_id))
+
+    rows = {}
+    for vfile, locations in by_file.items():
+        with open(vfile, 'rb') as f:
+            header = next(csv.reader([f.readline().decode()]))
+            for offset, trip_id in sorted(locations):
+                f.seek(offset)
+                # The reader pulls more lines when a quoted field spans several
+                rows[trip_id] = dict(zip(header, next(csv.reader(line.decode() for line in f))))
+    return rows
+
+def read_needed_trips(vfile, columns, trips_needed):
+    """Rows of vfile for trips in trips_needed, or None when the file has none.
+
+    A TripID-only pass decides whether the file is worth reading; the full read
+    then stops at the last needed row where the parser allows it. Columns the
+    file lacks are filled with ''.
+    """
+    with open(vfile, 'r', newline='') as f:
+        header = next(csv.reader(f), [])
+    present = [column for column in columns if column in header]
+
+    trip_ids = pd.read_csv(vfile, usecols=['TripID'], dtype=str, keep_default_na=False, engine=CSV_ENGINE)['TripID']
+    hits = np.flatnonzero(trip_ids.isin(trips_needed))
+    if len(hits) == 0:
+        return None
+
+    nrows = int(hits[-1]) + 1 if CSV_ENGINE == 'c' else None
+    trips = pd.read_csv(vfile, usecols=present, dtype=str, keep_default_na=False, engine=CSV_ENGINE, nrows=nrows)
+    return trips.iloc[hits].reindex(columns=columns, fill_value='')
+
+def load_trip_cache(cache_file, mtimes):
+    """Trips parsed on earlier runs, discarded when any vehicle file has changed"""
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['mtimes'] == mtimes:
+            return cached
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+    return {'mtimes': mtimes, 'trips': {}, 'missing': set()}
+
+def save_trip_cache(cache_file, trip_cache):
+    with open(cache_file, 'wb') as f:
+        pickle.dump(trip_cache, f, protocol=pickle.HIGHEST_PROTOCOL)